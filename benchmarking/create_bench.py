@@ -11,6 +11,8 @@ sys.path.append('../')
 
 from iwisdm import make
 from iwisdm import read_write
+from iwisdm.utils.frame_codec import FrameCodec
+from iwisdm.utils.writers import ArrayStoreWriter, TarShardWriter, TrialWriter, WriteBehind
 import iwisdm.envs.shapenet.task_generator as tg
 
 def create_task(env):
@@ -18,9 +20,9 @@ def create_task(env):
 
     return task
 
-def generate_trial(env, task, mode):
+def generate_trial(env, task, mode, render=True):
 
-    trials = env.generate_trials(tasks=[task], mode=mode)
+    trials = env.generate_trials(tasks=[task], mode=mode, render=render)
     imgs, _, info_dict = trials[0]
     instructions = info_dict['instruction']
 
@@ -56,57 +58,79 @@ def create_tasks(env, **kwargs):
         tasks = []
         task_strs = []
 
-    # Create tasks 
-    while len(tasks) < kwargs['n_tasks']:
-        task = create_task(env)
-        task_str = json.dumps(task.to_json())
+    # Trials are written into tar shards, array chunks, or into one folder of frames per trial
+    codec = FrameCodec.parse(kwargs['codec']) if kwargs['codec'] else None
+    if codec is not None and kwargs['output_format'] == 'array':
+        raise ValueError('frames of array stores are not encoded, --codec is only supported by folders and tar')
+    if kwargs['output_format'] == 'array' and kwargs['compression'] not in ArrayStoreWriter.COMPRESSIONS:
+        raise ValueError(f"--compression {kwargs['compression']} is not supported by array stores, only gz")
+    if kwargs['output_format'] == 'folders':
+        writer = TrialWriter(kwargs['n_writers'], codec=codec)
+    elif kwargs['output_format'] == 'tar':
+        shard_size = (kwargs['shard_size'] or 1024) * 2 ** 20
+        writer = TarShardWriter(kwargs['trials_dir'], shard_size, kwargs['compression'], codec=codec)
+    elif kwargs['output_format'] == 'array':
+        chunk_size = (kwargs['shard_size'] or 64) * 2 ** 20
+        writer = ArrayStoreWriter(kwargs['trials_dir'], chunk_size, kwargs['compression'])
+    # trials are written from a background thread while the next trials are generated,
+    # the queued trials are written and the writer is closed even if generation is interrupted
+    with WriteBehind(writer, kwargs['queue_size']) as writer:
+        # Create tasks 
+        while len(tasks) < kwargs['n_tasks']:
+            task = create_task(env)
+            task_str = json.dumps(task.to_json())
 
-        # Check if task meets length requirements
-        if  not (kwargs['min_len'] <= task.n_frames <= kwargs['max_len']):
-            continue
+            # Check if task meets length requirements
+            if  not (kwargs['min_len'] <= task.n_frames <= kwargs['max_len']):
+                continue
 
-        imgs, instructions, info_dict = generate_trial(env, task,
-                                                                mode='train' if kwargs['train'] else 'val')
-        n_and = instructions.count(' and ')
-        n_or = instructions.count(' or ')
+            # the constraints only need the instructions, skip rendering
+            _, instructions, info_dict = generate_trial(env, task, mode='train' if kwargs['train'] else 'val',
+                                                        render=False)
+            n_and = instructions.count(' and ')
+            n_or = instructions.count(' or ')
             
-        # Check if task meets joint operator requirements
-        if not (kwargs['min_joint_ops'] <= (n_and + n_or) <= kwargs['max_joint_ops']):
-            continue
+            # Check if task meets joint operator requirements
+            if not (kwargs['min_joint_ops'] <= (n_and + n_or) <= kwargs['max_joint_ops']):
+                continue
     
-        n_delay = task.n_frames - instructions.count('observe')
+            n_delay = task.n_frames - instructions.count('observe')
 
-        # Check if task meets delay frame requirements
-        if not (kwargs['min_delay'] <= n_delay <= kwargs['max_delay']):
-            continue
+            # Check if task meets delay frame requirements
+            if not (kwargs['min_delay'] <= n_delay <= kwargs['max_delay']):
+                continue
 
 
-        # Check if task is a duplicate
-        if not duplicate_check(tasks, task):
+            # Check if task is a duplicate
+            if not duplicate_check(tasks, task):
 
-            task_strs.append(task_str)
+                task_strs.append(task_str)
 
-            store_task(task, kwargs['tasks_dir'] + '/' + str(len(tasks)) + '.json')
+                store_task(task, kwargs['tasks_dir'] + '/' + str(len(tasks)) + '.json')
 
-            info_dicts = []
-            t_per_t = kwargs['n_trials'] // kwargs['n_tasks']
-            i = t_per_t
+                info_dicts = []
+                t_per_t = kwargs['n_trials'] // kwargs['n_tasks']
+                i = t_per_t
 
-            while i > 0:
-                imgs, _, info_dict = generate_trial(env, task, mode='train' if kwargs['train'] else 'val')
+                while i > 0:
+                    imgs, _, info_dict = generate_trial(env, task, mode='train' if kwargs['train'] else 'val')
 
-                if info_dict not in info_dicts:
-                    read_write.write_trial(imgs, info_dict, os.path.join(kwargs['trials_dir'], 'trial' + 
-                                                                            str(len(tasks) * t_per_t + t_per_t - i)))
-                    info_dicts.append(info_dict)
-                    i -= 1
+                    if info_dict not in info_dicts:
+                        trial_name = 'trial' + str(len(tasks) * t_per_t + t_per_t - i)
+                        if kwargs['output_format'] == 'folders':
+                            writer.write(imgs, info_dict, os.path.join(kwargs['trials_dir'], trial_name))
+                        else:
+                            writer.write(imgs, info_dict, key=trial_name)
+                        info_dicts.append(info_dict)
+                        i -= 1
+
+                print('tasks left to create:', kwargs['n_tasks'] - len(tasks))
+                tasks.append(task)
+            else:
+                print('duplicate task')
+                print('tasks left to create:', kwargs['n_tasks'] - len(tasks))
+                continue
 
-            print('tasks left to create:', kwargs['n_tasks'] - len(tasks))
-            tasks.append(task)
-        else:
-            print('duplicate task')
-            print('tasks left to create:', kwargs['n_tasks'] - len(tasks))
-            continue
     return tasks
 
 
@@ -168,6 +192,17 @@ if __name__ == '__main__':
     parser.add_argument('--max_joint_ops', type=int, default=2)
     parser.add_argument('--non_bool_actions', action='store_true', default=False)
     parser.add_argument('--shuffle', action='store_true', default=False)
+    parser.add_argument('--output_format', type=str, default='folders', choices=['folders', 'tar', 'array'])
+    parser.add_argument('--shard_size', type=int, default=None,
+                        help='maximum tar shard or array chunk size in MB, 1024 for tar shards and 64 for array chunks '
+                             'if not specified')
+    parser.add_argument('--compression', type=str, default=None, choices=['gz', 'bz2', 'xz'],
+                        help='compression of tar shards, array chunks only support gz')
+    parser.add_argument('--codec', type=str, default=None,
+                        help="frame encoding of folders and tar shards: png, jpeg, webp or npy, "
+                             "followed by the png level or the jpeg/webp quality, e.g. png:1, jpeg:90")
+    parser.add_argument('--n_writers', type=int, default=None, help='number of threads writing trial folders')
+    parser.add_argument('--queue_size', type=int, default=64, help='maximum number of trials waiting to be written')
     args = parser.parse_args()
 
     print(args)
@@ -540,5 +540,19 @@ class Env(object):
         """
         raise NotImplementedError
 
-    def render_trials(self):
+    def render_trials(self,
+                      compositional_infos: List,
+                      mode: str,
+                      out: np.ndarray = None,
+                      **kwargs) -> Tuple[np.ndarray, np.ndarray, List[Tuple[List[Dict], Dict]]]:
+        """
+        render a batch of trials into one array
+
+        @param compositional_infos: List of compositional task infos to render
+        @param mode: the dataset split [train/valid/test]
+        @param out: array of shape (n_trials, n_frames, img_size, img_size, 3) to render into
+        @return: tuple of
+        [movies array (n_trials, n_frames, img_size, img_size, 3), number of frames of each trial,
+        List of (Info dictionaries per task, Compositional task info dict)]
+        """
         raise NotImplementedError
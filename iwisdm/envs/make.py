@@ -9,6 +9,7 @@ def make(
         stim_data: StimData = None,
         env_spec: EnvSpec = None,
         dataset_fp: str = None,
+        **kwargs
 ):
     """
     create an environment instance with
@@ -21,6 +22,7 @@ def make(
     @param stim_data: Data class that contains the stimuli dataset directory
     @param env_spec: Data class that contains the environment specification
     @param dataset_fp: the file path to the stimuli dataset
+    @param kwargs: passed to env.init_stim_data, e.g. split='val' to only open the validation split
     @return:
     """
     assert env_id in env_dict, f"environment {env_id} not found in env_dict"
@@ -28,7 +30,7 @@ def make(
     if stim_data is None:
         if dataset_fp is None:
             dataset_fp = find_data_folder()
-        stim_data = env.init_stim_data(dataset_fp)
+        stim_data = env.init_stim_data(dataset_fp, **kwargs)
     if env_spec is None:
         env_spec = env.init_env_spec()
     env = env(stim_data, env_spec)
@@ -3,14 +3,22 @@ classes for registering a new environment
 """
 
 import glob
+import io
+import json
 import os
 from typing import Tuple, Iterable, Dict
 from collections import OrderedDict
+from functools import lru_cache
 
 import numpy as np
 from numpy.typing import NDArray
 import pandas as pd
 
+from iwisdm.utils.archive import TarArchive, is_tar_dataset
+
+
+DATASET_MANIFEST = 'dataset_manifest.json'
+
 
 class Constant:
     """
@@ -62,6 +70,7 @@ class EnvSpec:
         self.MAX_DELAY = max_delay
         self.delay_prob = delay_prob
         self.auto_gen_config = auto_gen_config
+        self.grid_size = tuple(grid_size)
         self.grid = get_grid(grid_size)
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -75,12 +84,20 @@ class EnvSpec:
         # convert from space to grid coordinate
         return list(self.grid.keys())[list(self.grid.values()).index(list(space.value))]
 
+    def get_slot_table(self, canvas_size: int):
+        """
+        @param canvas_size: the size of the rendered image
+        @return: SlotTable of the grid on a canvas of canvas_size
+        """
+        return get_slot_table(self.grid_size, canvas_size)
+
 
 class StimData:
     """
     class for storing and retrieving the stimuli dataset information
     Args:
-        dir_path: file path to the stimuli dataset. the folder has subdir structure:
+        dir_path: file path to the stimuli dataset, a folder or a tar archive of the folder.
+            the folder has subdir structure:
             dir_path:
                 -train
                     -imgs
@@ -95,6 +112,11 @@ class StimData:
         df: pandas dataframe, the metadata for the stimuli dataset
         img_folder_path: file path to the stimuli images
         splits: dictionary containing information to the train, validation, test splits
+        meta_fp: file path to the metadata, read on first access of df if df is not specified
+        use_manifest: if True and dir_path contains a dataset_manifest.json (see write_dataset_manifest),
+            read the metadata files and splits from the manifest instead of searching the dataset folder
+        archive: TarArchive the dataset is read from, opened from dir_path if dir_path is a tar archive.
+            paths in the dataset are then member names in the archive
     """
 
     def __init__(
@@ -103,36 +125,44 @@ class StimData:
             find_subdir: bool = True,
             df: pd.DataFrame = None,
             img_folder_path: str = None,
-            splits: Dict = None
+            splits: Dict = None,
+            meta_fp: str = None,
+            use_manifest: bool = True,
+            archive: TarArchive = None,
     ):
         self.dir_path = dir_path
         self.find_subdir = find_subdir
+        self._df = df
+        self.meta_fp = meta_fp
+        if archive is None and find_subdir and is_tar_dataset(dir_path):
+            archive = TarArchive(dir_path)
+        self.archive = archive
         if not find_subdir:
-            assert img_folder_path is not None and df is not None, \
-                'img_folder_path and df must be specified if find_subdir is False'
+            assert img_folder_path is not None and (df is not None or meta_fp is not None), \
+                'img_folder_path and df or meta_fp must be specified if find_subdir is False'
             self.img_folder_path = img_folder_path
-            self.df = df
             self.splits = splits
         else:
-            self.pkls = sorted([fname for fname in glob.glob(f'{dir_path}/**/*.pkl', recursive=True)])
-            self.csvs = sorted([fname for fname in glob.glob(f'{dir_path}/**/*.csv', recursive=True)])
-
             if not os.path.exists(self.dir_path):
                 raise ValueError('Data folder does not exist.')
+
+            manifest = read_dataset_manifest(dir_path) if use_manifest and self.archive is None else None
+            if self.archive is not None:
+                self.pkls = self.archive.glob('.pkl')
+                self.csvs = self.archive.glob('.csv')
+            elif manifest is not None:
+                self.pkls = [fp for fp in manifest['metadata'] if fp.endswith('.pkl')]
+                self.csvs = [fp for fp in manifest['metadata'] if fp.endswith('.csv')]
+                if splits is None:
+                    splits = manifest['splits']
+            else:
+                self.pkls = sorted([fname for fname in glob.glob(f'{dir_path}/**/*.pkl', recursive=True)])
+                self.csvs = sorted([fname for fname in glob.glob(f'{dir_path}/**/*.csv', recursive=True)])
             if not self.csvs and not self.pkls:
                 raise ValueError(f'No dataset meta information found in {dir_path}')
 
-            if df is not None:
-                self.df = df
-            else:
-                if self.csvs:
-                    fp = self.csvs[0]
-                    self.df = pd.read_csv(fp)
-                elif self.pkls:
-                    fp = self.pkls[0]
-                    self.df: pd.DataFrame = pd.read_pickle(fp)
-                if not self.csvs and not self.pkls:
-                    raise ValueError(f'No dataset meta information found in {dir_path}')
+            if df is None and meta_fp is None:
+                self.meta_fp = self.csvs[0] if self.csvs else self.pkls[0]
 
             if splits is not None:
                 self.splits = splits
@@ -151,6 +181,19 @@ class StimData:
                 if not self.img_folder_path:
                     raise ValueError('No image folder path found')
 
+    @property
+    def df(self) -> pd.DataFrame:
+        """
+        the metadata of the stimuli dataset, read from meta_fp on first access
+        """
+        if self._df is None and self.meta_fp is not None:
+            self._df = read_metadata(self.meta_fp, self.archive)
+        return self._df
+
+    @df.setter
+    def df(self, value: pd.DataFrame):
+        self._df = value
+
     def find_dataset_splits(self):
         assert self.find_subdir, 'find_subdir must be True to find dataset splits'
         splits = {
@@ -160,20 +203,19 @@ class StimData:
         }
         no_datafolder = True
         for split in splits.keys():
-            dirs = [fname for fname in glob.glob(f'{self.dir_path}/**/{split}', recursive=True)]
+            if self.archive is not None:
+                dirs = self.archive.find_dirs(split)
+            else:
+                dirs = [fname for fname in glob.glob(f'{self.dir_path}/**/{split}', recursive=True)]
             if dirs:
                 no_datafolder = False
                 assert len(dirs) == 1, f'found more than 1 folder for {split} split'
-                if os.path.isdir(dirs[0]):
+                if self.archive is not None or os.path.isdir(dirs[0]):
                     splits[split]['path'] = dirs[0]
-            if self.csvs:
-                df_fp = [fp for fp in self.csvs if split in fp.split('/')[-1]]
-                if df_fp:
-                    splits[split]['df'] = pd.read_csv(df_fp[0])
-            elif self.pkls:
-                df_fp = [fp for fp in self.pkls if split in fp.split('/')[-1]]
-                if df_fp:
-                    splits[split]['df'] = pd.read_pickle(df_fp[0])
+            meta_fps = self.csvs if self.csvs else self.pkls
+            df_fp = [fp for fp in meta_fps if split in fp.split('/')[-1]]
+            if df_fp:
+                splits[split]['meta_fp'] = df_fp[0]
         if no_datafolder:
             raise ValueError(f'No dataset splits found in data folder {self.dir_path}')
         return splits
@@ -182,6 +224,64 @@ class StimData:
         raise NotImplementedError
 
 
+def write_dataset_manifest(dir_path: str) -> Dict:
+    """
+    search the dataset folder once, and write the metadata files and split folders
+    into dir_path/dataset_manifest.json, paths are relative to dir_path.
+    StimData reads the manifest instead of searching the folder in later runs
+    @param dir_path: file path to the stimuli dataset
+    @return: the manifest dictionary
+    """
+    stim_data = StimData(dir_path, use_manifest=False)
+
+    def relpath(fp):
+        return os.path.relpath(fp, dir_path)
+
+    manifest = {
+        'metadata': [relpath(fp) for fp in stim_data.csvs + stim_data.pkls],
+        'splits': {
+            split: {k: relpath(v) for k, v in info.items() if k in ('path', 'meta_fp')}
+            for split, info in stim_data.splits.items()
+        }
+    }
+    with open(os.path.join(dir_path, DATASET_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def read_dataset_manifest(dir_path: str):
+    """
+    @param dir_path: file path to the stimuli dataset
+    @return: the manifest with paths joined to dir_path, None if the dataset has no manifest
+    """
+    fp = os.path.join(dir_path, DATASET_MANIFEST)
+    if not os.path.isfile(fp):
+        return None
+    with open(fp, 'r') as f:
+        manifest = json.load(f)
+    manifest['metadata'] = [os.path.join(dir_path, p) for p in manifest['metadata']]
+    manifest['splits'] = {
+        split: {k: os.path.join(dir_path, v) for k, v in info.items()}
+        for split, info in manifest['splits'].items()
+    }
+    return manifest
+
+
+def read_metadata(fp: str, archive: TarArchive = None) -> pd.DataFrame:
+    """
+    read the stimuli metadata file
+    @param fp: file path to the {csv/pkl} metadata
+    @param archive: if specified, fp is a member of the tar archive
+    @return: pandas dataframe
+    """
+    if archive is not None:
+        fp_or_buf = io.BytesIO(archive.read(fp))
+        return pd.read_csv(fp_or_buf) if fp.endswith('.csv') else pd.read_pickle(fp_or_buf)
+    if fp.endswith('.csv'):
+        return pd.read_csv(fp)
+    return pd.read_pickle(fp)
+
+
 def get_grid(grid_size):
     # return (grid_size,grid_size) array of sg.space.values
     # convert from grid to space
@@ -193,3 +293,46 @@ def get_grid(grid_size):
     grid_spaces = {(i, j): [(x_i, x_k), (y_i, y_k)] for i, (x_i, x_k) in enumerate(zip(xx[0::], xx[1::])) for
                    j, (y_i, y_k) in enumerate(zip(yy[0::], yy[1::]))}
     return OrderedDict(grid_spaces)
+
+
+class SlotTable:
+    """
+    placement of the stimuli on the canvas.
+    the canvas is divided into the cells of the grid, and each stimulus is drawn centered in the cell
+    that contains its location, at the largest size that fits in every cell
+    Args:
+        grid_size: number of (x, y) cells of the grid, see get_grid
+        canvas_size: the size of the rendered image
+    """
+
+    def __init__(self, grid_size: Tuple[int, int], canvas_size: int):
+        self.grid_size = tuple(grid_size)
+        self.canvas_size = canvas_size
+        n_x, n_y = self.grid_size
+        x_edges = [round(k * canvas_size / n_x) for k in range(n_x + 1)]
+        y_edges = [round(k * canvas_size / n_y) for k in range(n_y + 1)]
+        self.obj_size = min(b - a for edges in (x_edges, y_edges) for a, b in zip(edges, edges[1:]))
+
+        # grid key: (y slice, x slice) of the stimulus on the canvas, keys are ordered as in get_grid
+        self.slots = OrderedDict()
+        for i in range(n_x):
+            x0 = (x_edges[i] + x_edges[i + 1] - self.obj_size) // 2
+            for j in range(n_y):
+                y0 = (y_edges[j] + y_edges[j + 1] - self.obj_size) // 2
+                self.slots[(i, j)] = (slice(y0, y0 + self.obj_size), slice(x0, x0 + self.obj_size))
+
+    def __getitem__(self, key: Tuple[int, int]) -> Tuple[slice, slice]:
+        return self.slots[key]
+
+    def key_of(self, loc: Tuple[float, float]) -> Tuple[int, int]:
+        """
+        @param loc: (x, y) location in [0, 1]
+        @return: the key of the grid cell containing the location
+        """
+        n_x, n_y = self.grid_size
+        return min(int(loc[0] * n_x), n_x - 1), min(int(loc[1] * n_y), n_y - 1)
+
+
+@lru_cache(maxsize=None)
+def get_slot_table(grid_size: Tuple[int, int], canvas_size: int) -> SlotTable:
+    return SlotTable(grid_size, canvas_size)
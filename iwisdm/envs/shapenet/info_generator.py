@@ -7,7 +7,7 @@ import random
 import re
 from collections import defaultdict
 from functools import partial
-from typing import Tuple, Dict, List, Set
+from typing import Tuple, Dict, List, Set, Union
 
 import numpy as np
 
@@ -15,7 +15,8 @@ import iwisdm.envs.shapenet.registration as env_reg
 from iwisdm.envs.shapenet.registration import SNStimData
 import iwisdm.envs.shapenet.stim_generator as sg
 import iwisdm.envs.shapenet.task_generator as tg
-from iwisdm.utils.read_write import add_cross, render_stimset
+from iwisdm.utils.frame_format import DEFAULT_FORMAT, FrameFormat
+from iwisdm.utils.read_write import plan_stimset, render_plan, render_plan_shared
 
 
 class FrameInfo(object):
@@ -604,13 +605,17 @@ class TaskInfoCompo(object):
 
     def generate_trial(
             self,
-            canvas_size: int,
+            canvas_size: Union[int, List[int]],
             fixation_cue: bool,
             cue_on_action: bool,
             stim_data: SNStimData,
             return_objset: bool = False,
             add_distractor_frame: int = 0,
             add_distractor_time: int = 0,
+            share_frames: bool = False,
+            frame_format: FrameFormat = DEFAULT_FORMAT,
+            render: bool = True,
+            plan: List[Tuple] = None,
     ):
         # TODO: return copy of objset, not add distractor in place
         if add_distractor_frame > 0:
@@ -622,24 +627,103 @@ class TaskInfoCompo(object):
         objset = self.frame_info.objset
         per_task_info_dict, compo_info_dict = self.get_task_info_dict()
 
-        imgs = []
-        for i, (epoch, frame) in enumerate(zip(render_stimset(objset, canvas_size, stim_data), self.frame_info)):
-            if fixation_cue:
-                end_of_task = any('ending' in description for description in frame.description)
-                if cue_on_action:
-                    # add fixation cues to all frames except for task ending frames
-                    if end_of_task:
-                        epoch = add_cross(epoch)
-                else:
-                    # add fixation cues to all task ending frames
-                    if not end_of_task:
-                        epoch = add_cross(epoch)
-            imgs.append(epoch)
-
+        # the stimuli are sampled once, and rendered at each canvas size
+        canvas_sizes = list(canvas_size) if isinstance(canvas_size, (list, tuple)) else [canvas_size]
+        if render and plan is None:
+            plan = self.plan_frames(stim_data)
+        imgs, frame_ids = dict(), None
+        for size in canvas_sizes if render else []:
+            if share_frames:
+                imgs[size], frame_ids = self.render_shared(
+                    size, fixation_cue, cue_on_action, stim_data, frame_format, plan=plan
+                )
+            else:
+                imgs[size] = list(self.render(
+                    size, fixation_cue, cue_on_action, stim_data, frame_format=frame_format, plan=plan
+                ))
+        if not render:
+            imgs = None
+        elif not isinstance(canvas_size, (list, tuple)):
+            imgs = imgs[canvas_size]
+
+        trial = (imgs, per_task_info_dict, compo_info_dict)
         if return_objset:
             print('returning objset')
-            return imgs, per_task_info_dict, compo_info_dict, objset
-        return imgs, per_task_info_dict, compo_info_dict
+            trial += (objset,)
+        if share_frames:
+            trial += (frame_ids,)
+        return trial
+
+    def render(
+            self,
+            canvas_size: int,
+            fixation_cue: bool,
+            cue_on_action: bool,
+            stim_data: SNStimData,
+            out: np.ndarray = None,
+            frame_format: FrameFormat = DEFAULT_FORMAT,
+            plan: List[Tuple] = None,
+    ) -> np.ndarray:
+        """
+        render the frames of the trial, without adding distractors
+        @param canvas_size: the size of the rendered image
+        @param fixation_cue: if True, add fixation cues to the frames
+        @param cue_on_action: see SNEnvSpec
+        @param stim_data: the stimuli dataset
+        @param out: array to render into, see render_plan
+        @param frame_format: the output format of the frames, see FrameFormat
+        @param plan: the stimuli of each frame, sampled if not specified, see plan_frames
+        @return: movie array (n_epochs, canvas_size, canvas_size, 3)
+        """
+        slot_table = self.frame_info.objset.env_spec.get_slot_table(canvas_size)
+        if plan is None:
+            plan = self.plan_frames(stim_data)
+        cue = self.cue_frames(cue_on_action) if fixation_cue else None
+        frame_cache = stim_data.frame_cache if stim_data.frame_cache.max_bytes > 0 else None
+        return render_plan(plan, canvas_size, stim_data, slot_table, cue, out, frame_cache, frame_format)
+
+    def render_shared(
+            self,
+            canvas_size: int,
+            fixation_cue: bool,
+            cue_on_action: bool,
+            stim_data: SNStimData,
+            frame_format: FrameFormat = DEFAULT_FORMAT,
+            plan: List[Tuple] = None,
+    ) -> Tuple[List[np.ndarray], np.ndarray]:
+        """
+        render the frames of the trial, identical frames (e.g. delay frames) are one read-only array
+        @return: list of frames, and the frame ids, see render_plan_shared
+        """
+        slot_table = self.frame_info.objset.env_spec.get_slot_table(canvas_size)
+        if plan is None:
+            plan = self.plan_frames(stim_data)
+        cue = self.cue_frames(cue_on_action) if fixation_cue else None
+        frame_cache = stim_data.frame_cache if stim_data.frame_cache.max_bytes > 0 else None
+        return render_plan_shared(plan, canvas_size, stim_data, slot_table, cue, frame_cache, frame_format)
+
+    def plan_frames(self, stim_data: SNStimData) -> List[Tuple]:
+        """
+        sample the stimuli of the trial, the plan can be rendered at any canvas size
+        @param stim_data: the stimuli dataset
+        @return: the (stimulus ref, grid key) of each object of each frame, see plan_stimset
+        """
+        objset = self.frame_info.objset
+        # grid keys do not depend on the canvas size
+        slot_table = objset.env_spec.get_slot_table(objset.env_spec.canvas_size)
+        return plan_stimset(objset, stim_data, slot_table)
+
+    def cue_frames(self, cue_on_action: bool) -> np.ndarray:
+        """
+        @param cue_on_action: see SNEnvSpec
+        @return: boolean array of the frames with a fixation cue.
+            if cue_on_action, the cue is added to the task ending frames, otherwise to all other frames
+        """
+        end_of_task = np.array(
+            [any('ending' in description for description in frame.description) for frame in self.frame_info],
+            dtype=bool,
+        )
+        return end_of_task if cue_on_action else ~end_of_task
 
     def __len__(self):
         # return number of tasks involved
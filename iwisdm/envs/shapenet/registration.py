@@ -1,15 +1,24 @@
 import os
+import json
 import re
-from typing import Tuple, Dict, List
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Tuple, Dict, List, Iterable
 import random
 
+import cv2
 import pandas as pd
 import numpy as np
 from numpy.typing import NDArray
 
 from iwisdm.core import Stimulus
 from iwisdm.envs.registration import Constant, EnvSpec, StimData
-from iwisdm.utils.read_write import read_img
+from iwisdm.utils.read_write import read_img, decode_img, resize_img
+from iwisdm.utils.cache import LRUCache
+from iwisdm.utils.frame_format import FrameFormat
+from iwisdm.utils.atlas import StimAtlas, read_decode_settings
+from iwisdm.utils.archive import TarArchive
+from iwisdm.utils.shared import SharedStimBlock, shared_block_name
 
 
 def compare_when(when_list):
@@ -250,32 +259,260 @@ class SNEnvSpec(EnvSpec):
 
 
 class SNStimData(StimData):
+    """
+    ShapeNet stimuli dataset
+    Args:
+        cache_bytes: memory budget of the cache of decoded and resized stimuli, 0 disables caching.
+            each split keeps its own cache, besides the cache of the whole dataset, so a process holds up to
+            (1 + number of loaded splits) * cache_bytes, e.g. 1 GB with the default and the three splits loaded
+        use_atlas: if True, serve stimuli from compiled atlases (see iwisdm/utils/atlas.py)
+            found in the image folder instead of decoding the images
+        index_cache: if True, save the attribute index built from the metadata next to the metadata file,
+            and load it in later runs as long as the metadata file is unchanged
+        shared_memory: if True, the resized stimuli of each split are loaded into a shared memory block
+            by the first process, and read from that block by every process using the same dataset
+        prefetch_workers: number of threads loading stimuli in the background, see prefetch
+        reduced_decode: if True, decode the stimulus images at the smallest reduced resolution
+            (1/2, 1/4 or 1/8) that is still larger than the stimulus size, before resizing.
+            the source image size is read from the first decoded image of the dataset.
+            only JPEG sources decode faster at reduced resolution, PNG images are fully decoded either way
+        interpolation: cv2 interpolation used to resize the decoded images to the stimulus size.
+            compiled atlases are only used with the settings they were compiled with, full decoding and
+            cv2.INTER_LINEAR
+        frame_cache_bytes: memory budget of the cache of rendered frames with at most one stimulus,
+            0 disables caching. each split keeps its own cache, as for cache_bytes
+    """
+
+    INDEX_VERSION = 2
+
     def __init__(
             self,
             dir_path: str = None,
             find_subdir: bool = True,
             df: pd.DataFrame = None,
             img_folder_path: str = None,
-            splits: Dict = None
+            splits: Dict = None,
+            meta_fp: str = None,
+            archive: TarArchive = None,
+            cache_bytes: int = 2 ** 28,
+            use_atlas: bool = True,
+            index_cache: bool = True,
+            shared_memory: bool = False,
+            prefetch_workers: int = 4,
+            reduced_decode: bool = False,
+            interpolation: int = cv2.INTER_LINEAR,
+            frame_cache_bytes: int = 0,
     ):
-        super().__init__(dir_path, find_subdir, df, img_folder_path, splits)
+        super().__init__(dir_path, find_subdir, df, img_folder_path, splits, meta_fp, archive=archive)
+        self.cache = LRUCache(cache_bytes)
+        self.frame_cache = LRUCache(frame_cache_bytes)
+        self.use_atlas = use_atlas
+        self.index_cache = index_cache
+        self.shared_memory = shared_memory
+        self.prefetch_workers = prefetch_workers
+        self.prefetcher = None
+        self.reduced_decode = reduced_decode
+        self.interpolation = interpolation
+        self.src_size = None
+        self.atlases = dict()
+        self.shared_blocks = dict()
+        self._shared_lock = threading.Lock()
+        # options shared with the split datasets
+        self.split_kwargs = dict(
+            cache_bytes=cache_bytes,
+            use_atlas=use_atlas,
+            index_cache=index_cache,
+            shared_memory=shared_memory,
+            prefetch_workers=prefetch_workers,
+            reduced_decode=reduced_decode,
+            interpolation=interpolation,
+            frame_cache_bytes=frame_cache_bytes,
+        )
         if self.find_subdir:
-            for k, v in self.splits.items():
-                if v:
-                    assert v['path'] and v['df'] is not None, 'missing path or data for split {k}'
-                    v['data'] = SNStimData(
-                        dir_path=v['path'],
-                        find_subdir=False,
-                        df=v['df'],
-                        img_folder_path=v['path'],
-                        splits=None
-                    )
-        self.ATTR_DICT = self.get_all_attributes(self.df)
-        self.attr_with_mapping = self.get_attr_str_mapping()
+            # split datasets are loaded on first access of splits[mode]['data']
+            self.splits = {k: LazySplit(k, v, self.load_split) for k, v in self.splits.items()}
+
+        index = self.read_attr_index() if self.index_cache else None
+        if index is not None:
+            self.ATTR_DICT, self.attr_with_mapping = index
+        else:
+            self.ATTR_DICT = self.get_all_attributes(self.df)
+            self.attr_with_mapping = self.get_attr_str_mapping()
+            if self.index_cache:
+                self.write_attr_index()
         self.ALLCATEGORIES = list(self.ATTR_DICT.keys())
         self.ALLOBJECTS = {c: list(self.ATTR_DICT[c].keys()) for c in self.ATTR_DICT}
         self.ALLVIEWANGLES = {c: {obj: list(info.keys()) for obj, info in d.items()} for c, d in self.ATTR_DICT.items()}
         self.ALL_ATTRS = {'location', 'category'}
+        self.build_tables()
+
+    def __getstate__(self):
+        # thread pools, shared memory blocks and memory-mapped atlases are reopened by each process
+        state = self.__dict__.copy()
+        state['prefetcher'] = None
+        state['shared_blocks'] = dict()
+        state['atlases'] = dict()
+        del state['_shared_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shared_lock = threading.Lock()
+
+    def close(self) -> None:
+        """
+        stop the prefetch threads, and detach from the shared memory blocks of this dataset and of its loaded splits.
+        the blocks created by this process are removed
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=True)
+            self.prefetcher = None
+        with self._shared_lock:
+            for block in self.shared_blocks.values():
+                block.close()
+            self.shared_blocks = dict()
+        if self.splits:
+            for v in self.splits.values():
+                if v.get('data') is not None and v['data'] is not self:
+                    v['data'].close()
+
+    def load_split(self, split: str, info: Dict):
+        """
+        build the dataset of a split
+        @param split: the split name
+        @param info: the split information, see StimData.find_dataset_splits
+        @return: SNStimData instance of the split
+        """
+        assert info.get('path') and (info.get('df') is not None or info.get('meta_fp')), \
+            f'missing path or data for split {split}'
+        return SNStimData(
+            dir_path=info['path'],
+            find_subdir=False,
+            df=info.get('df'),
+            img_folder_path=info['path'],
+            splits=None,
+            meta_fp=info.get('meta_fp'),
+            archive=self.archive,
+            **self.split_kwargs,
+        )
+
+    @classmethod
+    def from_split(cls, dir_path: str, split: str, **kwargs):
+        """
+        open a single split of the dataset without loading the other splits or the dataset metadata
+        @param dir_path: file path to the stimuli dataset
+        @param split: the split name, [train, val, test]
+        @param kwargs: SNStimData options
+        @return: SNStimData instance of the split, with the split itself as its only entry in splits
+        """
+        dataset = StimData(dir_path)
+        info = dataset.splits[split]
+        if not info:
+            raise ValueError(f'split {split} not found in data folder {dir_path}')
+        stim_data = cls(
+            dir_path=info['path'],
+            find_subdir=False,
+            df=info.get('df'),
+            img_folder_path=info['path'],
+            splits=None,
+            meta_fp=info.get('meta_fp'),
+            archive=dataset.archive,
+            **kwargs,
+        )
+        stim_data.splits = {split: dict(info, data=stim_data)}
+        return stim_data
+
+    def build_tables(self) -> None:
+        """
+        flatten ATTR_DICT into integer-coded columnar tables.
+        the objects of the i-th category are object_ids[object_offsets[i]:object_offsets[i + 1]],
+        the view angles of the j-th object are view_angle_ids[view_angle_offsets[j]:view_angle_offsets[j + 1]],
+        the refs of the k-th view angle are refs[ref_offsets[k]:ref_offsets[k + 1]]
+        """
+        objects, view_angles, refs = list(), list(), list()
+        object_offsets, view_angle_offsets, ref_offsets = [0], [0], [0]
+        self.category_index, self.object_index, self.view_angle_index = dict(), dict(), dict()
+        for i, (cat, cat_dict) in enumerate(self.ATTR_DICT.items()):
+            self.category_index[cat] = i
+            for obj, obj_dict in cat_dict.items():
+                self.object_index[(cat, obj)] = len(objects)
+                objects.append(obj)
+                for va, va_refs in obj_dict.items():
+                    self.view_angle_index[(cat, obj, va)] = len(view_angles)
+                    view_angles.append(va)
+                    refs.extend(va_refs)
+                    ref_offsets.append(len(refs))
+                view_angle_offsets.append(len(view_angles))
+            object_offsets.append(len(objects))
+
+        self.category_ids = np.array(self.ALLCATEGORIES)
+        self.object_ids = np.array(objects)
+        self.view_angle_ids = np.array(view_angles)
+        self.refs = np.array(refs, dtype=np.int64)
+        self.object_offsets = np.array(object_offsets, dtype=np.int64)
+        self.view_angle_offsets = np.array(view_angle_offsets, dtype=np.int64)
+        self.ref_offsets = np.array(ref_offsets, dtype=np.int64)
+
+    @staticmethod
+    def _sample_index(start: int, stop: int, exclude: int = None) -> int:
+        """
+        draw an index uniformly from [start, stop), other than exclude if it is specified
+        """
+        if exclude is None:
+            return random.randrange(start, stop)
+        i = random.randrange(start, stop - 1)
+        return i + 1 if i >= exclude else i
+
+    def sample_category(self, exclude=None):
+        """
+        @param exclude: a category value to avoid
+        @return: a random category value
+        """
+        exclude = None if exclude is None else self.category_index[exclude]
+        return self.category_ids[self._sample_index(0, len(self.category_ids), exclude)].item()
+
+    def sample_object(self, category, exclude=None):
+        """
+        @param category: the category value of the object
+        @param exclude: an object value of the category to avoid
+        @return: a random object value of the category
+        """
+        i = self.category_index[category]
+        exclude = None if exclude is None else self.object_index[(category, exclude)]
+        return self.object_ids[
+            self._sample_index(self.object_offsets[i], self.object_offsets[i + 1], exclude)
+        ].item()
+
+    def sample_view_angle(self, category, obj, exclude=None):
+        """
+        @param category: the category value of the object
+        @param obj: the object value
+        @param exclude: a view angle value of the object to avoid
+        @return: a random view angle value of the object
+        """
+        j = self.object_index[(category, obj)]
+        exclude = None if exclude is None else self.view_angle_index[(category, obj, exclude)]
+        return self.view_angle_ids[
+            self._sample_index(self.view_angle_offsets[j], self.view_angle_offsets[j + 1], exclude)
+        ].item()
+
+    def sample_ref(self, category, obj, view_angle) -> int:
+        """
+        @return: a random stimulus reference of the (category, object, view angle) stimulus
+        """
+        k = self.view_angle_index.get((category, obj, view_angle))
+        if k is None or self.ref_offsets[k] == self.ref_offsets[k + 1]:
+            raise ValueError(f'ShapeNet object with '
+                             f'category {category}, identity {obj}, view angle {view_angle} not found')
+        return self.refs[random.randrange(self.ref_offsets[k], self.ref_offsets[k + 1])].item()
+
+    def n_objects(self, category) -> int:
+        i = self.category_index[category]
+        return int(self.object_offsets[i + 1] - self.object_offsets[i])
+
+    def n_view_angles(self, category, obj) -> int:
+        j = self.object_index[(category, obj)]
+        return int(self.view_angle_offsets[j + 1] - self.view_angle_offsets[j])
 
     def get_object(self, obj: Stimulus, obj_size: Tuple[int, int], mode: str = None) -> NDArray:
         """
@@ -286,24 +523,143 @@ class SNStimData(StimData):
         @return: image array, RGB format
         """
         if mode:
-            image_path = self.splits[mode]['path']
-            if self.splits[mode]['data']:
-                attr_dict = self.splits[mode]['data'].ATTR_DICT
-            else:
-                attr_dict = self.get_all_attributes(self.splits[mode]['df'])
-        else:
-            image_path = self.img_folder_path
-            attr_dict = self.ATTR_DICT
-
-        refs = attr_dict[obj.category][obj.object][obj.view_angle]
-        if not refs:
-            raise ValueError(f'ShapeNet object with '
-                             f'category {obj.category}, identity {obj.object}, view angle {obj.view_angle} not found')
+            return self.splits[mode]['data'].get_object(obj, obj_size)
+        return self.load_object(self.sample_ref(obj.category, obj.object, obj.view_angle), obj_size)
 
-        obj_ref = random.choice(refs)
-        obj_path = os.path.join(image_path, f'{obj_ref}/image.png')
+    def load_object(self, ref: int, obj_size: Tuple[int, int], frame_format: FrameFormat = None) -> NDArray:
+        """
+        Get the resized image array of a stimulus reference, decoded images are cached per split
+        @param ref: the stimulus reference in the dataset metadata
+        @param obj_size: the size of the stimulus on the canvas
+        @param frame_format: output format of the image, converted images are cached as well
+        @return: read-only image array
+        """
+        if frame_format is not None and not frame_format.is_default:
+            key = (ref, tuple(obj_size), frame_format.key)
+            object_arr = self.cache.get(key)
+            if object_arr is None:
+                object_arr = self.cache.put(key, frame_format.convert(self.load_object(ref, obj_size)))
+            return object_arr
+
+        atlas = self.get_atlas(obj_size)
+        if atlas is not None and ref in atlas:
+            return atlas[ref]
+
+        block = self.get_shared_block(obj_size)
+        if block is not None and ref in block:
+            return block[ref]
+
+        key = (ref, tuple(obj_size))
+        object_arr = self.cache.get(key)
+        if object_arr is None:
+            object_arr = self.cache.put(key, self.read_object(ref, obj_size))
+        return object_arr
+
+    def prefetch(self, refs: Iterable[int], obj_size: Tuple[int, int]) -> List[Future]:
+        """
+        load the stimuli into the cache from background threads, so that rendering them later does not wait on I/O.
+        image decoding releases the GIL, so the stimuli are loaded while the calling thread generates trials.
+        nothing is loaded if the stimuli are served from an atlas or a shared memory block at obj_size
+        @param refs: the stimulus references, e.g. of a frame plan, see TaskInfoCompo.plan_frames
+        @param obj_size: the size of the stimulus on the canvas
+        @return: futures of the loads
+        """
+        if self.cache.max_bytes <= 0 or self.prefetch_workers <= 0:
+            return []
+        if self.get_atlas(obj_size) is not None or (self.shared_memory and obj_size[0] == obj_size[1]):
+            return []
+        if self.prefetcher is None:
+            self.prefetcher = ThreadPoolExecutor(max_workers=self.prefetch_workers)
+
+        futures = list()
+        for ref in dict.fromkeys(refs):
+            if (ref, tuple(obj_size)) not in self.cache:
+                futures.append(self.prefetcher.submit(self.load_object, ref, obj_size))
+        return futures
+
+    def read_object(self, ref: int, obj_size: Tuple[int, int]) -> NDArray:
+        """
+        decode and resize the image of a stimulus reference, bypassing the caches
+        @param ref: the stimulus reference in the dataset metadata
+        @param obj_size: the size of the stimulus on the canvas
+        @return: image array
+        """
+        obj_path = os.path.join(self.img_folder_path, f'{ref}/image.png')
+        buf = self.archive.read(obj_path) if self.archive is not None else None
+        if self.reduced_decode and self.src_size is None:
+            image = cv2.imread(obj_path) if buf is None else cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                raise ValueError(f'unable to read stimulus image {obj_path}')
+            self.src_size = min(image.shape[:2])
+            return resize_img(image, obj_size, self.interpolation)
+
+        src_size = self.src_size if self.reduced_decode else None
+        if buf is not None:
+            return decode_img(buf, obj_size, 'RGB', src_size, self.interpolation)
+        return read_img(obj_path, obj_size, 'RGB', src_size, self.interpolation)
+
+    def get_shared_block(self, obj_size: Tuple[int, int]):
+        """
+        create, or attach to, the shared memory block holding the stimuli of this dataset at obj_size
+        @param obj_size: the size of the stimulus on the canvas
+        @return: SharedStimBlock instance, None if shared_memory is disabled
+        """
+        if not self.shared_memory or obj_size[0] != obj_size[1]:
+            return None
+        size = obj_size[0]
+        block = self.shared_blocks.get(size)
+        if block is not None:
+            return block
+        # prefetch threads must not create the same block twice
+        with self._shared_lock:
+            if size not in self.shared_blocks:
+                refs = np.unique(self.refs)
+                source = self.archive.fp if self.archive is not None else ''
+                name = shared_block_name(
+                    os.path.abspath(source), os.path.abspath(self.img_folder_path), size,
+                    self.reduced_decode, self.interpolation, refs
+                )
+                self.shared_blocks[size] = SharedStimBlock(
+                    name, refs.tolist(), size, lambda ref: self.read_object(ref, (size, size))
+                )
+            return self.shared_blocks[size]
+
+    def get_atlas(self, obj_size: Tuple[int, int]):
+        """
+        open the compiled atlas of the image folder for the given stimulus size.
+        atlases compiled with other reduced_decode or interpolation settings are not used, see atlas_manifest.json
+        @param obj_size: the size of the stimulus on the canvas
+        @return: StimAtlas instance, None if no matching atlas was compiled for this size
+        """
+        if not self.use_atlas or self.archive is not None or obj_size[0] != obj_size[1]:
+            return None
+        size = obj_size[0]
+        if size not in self.atlases:
+            settings = {'reduced_decode': self.reduced_decode, 'interpolation': self.interpolation}
+            if (StimAtlas.exists(self.img_folder_path, size)
+                    and read_decode_settings(self.img_folder_path) == settings):
+                self.atlases[size] = StimAtlas.open(self.img_folder_path, size)
+            else:
+                self.atlases[size] = None
+        return self.atlases[size]
 
-        return read_img(obj_path, obj_size, color_format='RGB')
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        @return: stimulus cache counters of this dataset and of each split, keyed by split name,
+            and frame cache counters keyed by {split name}_frames if the frame cache is enabled
+        """
+        datasets = {'all': self}
+        if self.splits:
+            for k, v in self.splits.items():
+                # only report the splits that were loaded
+                if v.get('data') is not None and v['data'] is not self:
+                    datasets[k] = v['data']
+        stats = dict()
+        for k, data in datasets.items():
+            stats[k] = data.cache.stats()
+            if data.frame_cache.max_bytes > 0:
+                stats[f'{k}_frames'] = data.frame_cache.stats()
+        return stats
 
     @staticmethod
     def get_all_attributes(df):
@@ -311,21 +667,78 @@ class SNStimData(StimData):
         Get all shapenet attributes from the dataset, including the hierarchy
         @return: dictionary of the format {category: {object: [view angles]}}
         """
-        ATTR_DICT = dict()
+        # a single groupby pass, groups are visited in order of first appearance
+        # so categories, objects and view angles keep the metadata order
+        df = df.drop_duplicates(['ctg_mod', 'obj_mod', 'ang_mod', 'ref'])
+        groups = df.groupby(['ctg_mod', 'obj_mod', 'ang_mod'], sort=False)['ref'].agg(list)
 
-        for cat in df['ctg_mod'].unique():
-            ATTR_DICT[cat] = dict()
-            unique_obj = df[df['ctg_mod'] == cat]['obj_mod'].unique()
-            for obj in unique_obj:
-                ATTR_DICT[cat][obj] = dict()
-                unique_va = df[(df['ctg_mod'] == cat) & (df['obj_mod'] == obj)]['ang_mod'].unique()
-                for va in unique_va:
-                    refs = df[
-                        (df['ctg_mod'] == cat) & (df['obj_mod'] == obj) & (df['ang_mod'] == va)
-                        ]['ref'].unique()
-                    ATTR_DICT[cat][obj][va] = list(map(int, refs))
+        ATTR_DICT = dict()
+        for (cat, obj, va), refs in zip(groups.index.tolist(), groups.tolist()):
+            ATTR_DICT.setdefault(cat, dict()).setdefault(obj, dict())[va] = list(map(int, refs))
         return ATTR_DICT
 
+    def attr_index_fp(self) -> Tuple[str, Tuple]:
+        """
+        @return: the attribute index file path next to the metadata file,
+            and the fingerprint of the metadata file the index is valid for.
+            for datasets read from an archive, the index is saved next to the archive
+        """
+        if self.archive is not None:
+            fingerprint = (self.INDEX_VERSION,) + self.archive.fingerprint() + (self.meta_fp,)
+            return f'{self.archive.fp}.{self.meta_fp.replace("/", "_")}.iwisdm-index.json', fingerprint
+        stat = os.stat(self.meta_fp)
+        fingerprint = (self.INDEX_VERSION, os.path.abspath(self.meta_fp), stat.st_size, stat.st_mtime_ns)
+        return f'{self.meta_fp}.iwisdm-index.json', fingerprint
+
+    def read_attr_index(self):
+        """
+        load ATTR_DICT and attr_with_mapping saved by a previous run, without reading the metadata
+        @return: tuple of (ATTR_DICT, attr_with_mapping), None if no valid index is found
+        """
+        if self._df is not None or self.meta_fp is None:
+            return None
+        index_fp, fingerprint = self.attr_index_fp()
+        if not os.path.isfile(index_fp):
+            return None
+        try:
+            with open(index_fp) as f:
+                index = json.load(f)
+            if index.get('fingerprint') != list(fingerprint):
+                return None
+            # JSON object keys are strings, the attribute values are stored as lists of [value, ...] rows
+            ATTR_DICT = dict()
+            for cat, obj, va, refs in index['ATTR_DICT']:
+                ATTR_DICT.setdefault(cat, dict()).setdefault(obj, dict())[va] = refs
+            attr_with_mapping = {attr: dict(rows) for attr, rows in index['attr_with_mapping'].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return ATTR_DICT, attr_with_mapping
+
+    def write_attr_index(self) -> None:
+        """
+        save ATTR_DICT and attr_with_mapping next to the metadata file,
+        the dataset folder may be read-only, in which case the index is not saved
+        """
+        if self.meta_fp is None:
+            return
+        index_fp, fingerprint = self.attr_index_fp()
+        index = {
+            'fingerprint': list(fingerprint),
+            'ATTR_DICT': [
+                [cat, obj, va, refs]
+                for cat, objs in self.ATTR_DICT.items() for obj, vas in objs.items() for va, refs in vas.items()
+            ],
+            'attr_with_mapping': {attr: list(mapping.items()) for attr, mapping in self.attr_with_mapping.items()},
+        }
+        tmp_fp = f'{index_fp}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_fp, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_fp, index_fp)
+        except OSError:
+            if os.path.exists(tmp_fp):
+                os.remove(tmp_fp)
+
     def get_attr_str_mapping(self):
         """
         get the mapping from integer attribute value to string description
@@ -334,13 +747,34 @@ class SNStimData(StimData):
         """
         self.attr_with_mapping = dict()
         if 'ctg' in self.df.columns.values:
+            labels = self.df.groupby('ctg_mod', sort=False)['ctg'].unique()
             IDX2Category = dict()
-            for cat, _ in self.ATTR_DICT.items():
-                labels = self.df[self.df['ctg_mod'] == cat]['ctg']
-                assert len(set(labels)) == 1, f'found more than 1 label for the cateogry {cat}'
-                IDX2Category[cat] = set(labels).pop()
+            for cat, cat_labels in zip(labels.index.tolist(), labels.tolist()):
+                assert len(cat_labels) == 1, f'found more than 1 label for the cateogry {cat}'
+                IDX2Category[cat] = cat_labels[0]
             self.attr_with_mapping['category'] = IDX2Category
         return self.attr_with_mapping
 
 
+class LazySplit(dict):
+    """
+    information of a dataset split, the 'data' entry is loaded on first access
+    Args:
+        split: the split name
+        info: the split information, see StimData.find_dataset_splits
+        load: callable building the split dataset from (split, info)
+    """
+
+    def __init__(self, split: str, info: Dict, load):
+        super().__init__(info)
+        self.split = split
+        self.load = load
+
+    def __missing__(self, key):
+        if key != 'data' or not self:
+            raise KeyError(key)
+        self['data'] = self.load(self.split, self)
+        return self['data']
+
+
 DATA = SNConst()
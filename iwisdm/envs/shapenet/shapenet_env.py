@@ -1,5 +1,5 @@
 import random
-from typing import Tuple, List, Dict, Iterable, Union
+from typing import Tuple, List, Dict, Iterable, Iterator, Optional, Union
 
 import networkx as nx
 import json
@@ -14,6 +14,8 @@ import iwisdm.envs.shapenet.info_generator as ig
 import iwisdm.envs.shapenet.registration as env_reg
 from iwisdm.envs.shapenet.registration import SNEnvSpec, SNStimData
 from iwisdm.envs.shapenet.task_bank import task_family_dict
+from iwisdm.utils.frame_format import DEFAULT_FORMAT, FrameFormat
+from iwisdm.utils.read_write import apply_cross
 
 GRAPH_TUPLE = Tuple[nx.DiGraph, int, int]
 TASK = Tuple[Union[Operator, Attribute], Task]
@@ -36,8 +38,15 @@ class ShapeNetEnv(Env):
         return
 
     @staticmethod
-    def init_stim_data(dataset_fp: str, **kwargs):
-        stim_data = SNStimData(dataset_fp)
+    def init_stim_data(dataset_fp: str, split: str = None, **kwargs):
+        """
+        @param dataset_fp: the file path to the stimuli dataset
+        @param split: if specified, only open this split of the dataset
+        @param kwargs: SNStimData options
+        """
+        if split is not None:
+            return SNStimData.from_split(dataset_fp, split, **kwargs)
+        stim_data = SNStimData(dataset_fp, **kwargs)
         return stim_data
 
     @staticmethod
@@ -160,50 +169,181 @@ class ShapeNetEnv(Env):
             compositional_infos: Iterable[ig.TaskInfoCompo] = None,
             mode: str = None,
             return_objset: bool = False,
+            prefetch: int = 0,
+            share_frames: bool = False,
+            frame_format: FrameFormat = DEFAULT_FORMAT,
+            canvas_size: Union[int, List[int]] = None,
+            render: bool = True,
             **kwargs
     ) -> List[Tuple[List[np.ndarray], List[Dict], Dict]]:
+        """
+        generate trials from tasks, or from existing compositional task infos
+        @param tasks: the tasks to generate trials of, the cached tasks if not specified
+        @param task_objsets: the objsets of the tasks, generated if not specified
+        @param compositional_infos: compositional task infos to generate trials of
+        @param mode: the dataset split to sample stimuli from
+        @param return_objset: if True, also return the objset of each trial
+        @param prefetch: number of upcoming trials whose stimuli are loaded in background threads
+            while the current trial is generated
+        @param share_frames: if True, identical frames of a trial (e.g. delay frames) are returned as the same
+            read-only array, and the frame ids of each trial are appended to the trial, see render_plan_shared
+        @param frame_format: dtype, normalization, channel order and layout of the frames, see FrameFormat
+        @param canvas_size: the size of the rendered images, env_spec.canvas_size if not specified.
+            given a list of sizes, each trial is sampled once and rendered at every size,
+            and the images of each trial are a dictionary of canvas size: frames
+        @param render: if False, only the task information of the trials is generated, and the images are None.
+            no stimuli are sampled or loaded, e.g. for text-only tasks, or to check the task constraints
+        @param kwargs: passed to TaskInfoCompo.generate_trial
+        @return: list of trials
+        """
         self.reset_env(mode)
-        if mode:
-            if mode in self.stim_data.splits:
-                stim_data = self.stim_data.splits[mode]['data']
-            else:
-                raise ValueError(
-                    f"mode {mode} not found in stim_data splits, only {self.stim_data.splits.keys()} splits")
-        else:
-            stim_data = self.stim_data
+        stim_data = self.get_stim_data(mode)
 
         if not compositional_infos:
             if not tasks:
                 tasks = self.cached_tasks
             compositional_infos = self.init_compositional_tasks(tasks, task_objsets)
+        compositional_infos = list(compositional_infos)
+
+        if canvas_size is None:
+            canvas_size = self.env_spec.canvas_size
+        canvas_sizes = canvas_size if isinstance(canvas_size, (list, tuple)) else [canvas_size]
 
         trials = list()
-        for compo_info in compositional_infos:
-            if return_objset:
-                imgs, per_task_info, compo_info_dict, objset = compo_info.generate_trial(
-                    self.env_spec.canvas_size,
-                    self.env_spec.add_fixation_cue,
-                    self.env_spec.cue_on_action,
-                    stim_data,
-                    return_objset,
-                    **kwargs
-                )
-                trials.append((imgs, per_task_info, compo_info_dict, objset))
-            else:
-                imgs, per_task_info, compo_info_dict = compo_info.generate_trial(
-                    self.env_spec.canvas_size,
-                    self.env_spec.add_fixation_cue,
-                    self.env_spec.cue_on_action,
-                    stim_data,
-                    **kwargs
-                )
-                trials.append((imgs, per_task_info, compo_info_dict))
+        # distractors are sampled when the trial is generated, after the stimuli would be sampled ahead
+        if not render or kwargs.get('add_distractor_frame') or kwargs.get('add_distractor_time'):
+            prefetch = 0
+        for compo_info, plan in self.prefetch_trials(compositional_infos, stim_data, prefetch, canvas_sizes):
+            trials.append(compo_info.generate_trial(
+                canvas_size,
+                self.env_spec.add_fixation_cue,
+                self.env_spec.cue_on_action,
+                stim_data,
+                return_objset,
+                share_frames=share_frames,
+                frame_format=frame_format,
+                render=render,
+                plan=plan,
+                **kwargs
+            ))
         return trials
 
-    def render_trials(self):
-        self.reset_env()
+    def get_stim_data(self, mode: str = None) -> SNStimData:
+        """
+        @param mode: the dataset split
+        @return: the stimuli dataset of the split, the whole dataset if mode is not specified
+        """
+        if not mode:
+            return self.stim_data
+        splits = self.stim_data.splits or dict()
+        if not splits.get(mode):
+            raise ValueError(f"mode {mode} not found in stim_data splits, only {list(splits.keys())} splits")
+        return self.stim_data.splits[mode]['data']
 
-        return
+    def prefetch_trials(
+            self,
+            compositional_infos: List[ig.TaskInfoCompo],
+            stim_data: SNStimData,
+            prefetch: int = 0,
+            canvas_sizes: List[int] = None,
+    ) -> Iterator[Tuple[ig.TaskInfoCompo, Optional[List[Tuple]]]]:
+        """
+        iterate over the compositional task infos, while loading the stimuli of the next prefetch trials
+        in background threads, see SNStimData.prefetch.
+        the stimuli of the prefetched trials are sampled ahead, in trial order, so that only the sampled stimuli
+        are loaded
+        @param canvas_sizes: the canvas sizes the trials are rendered at, env_spec.canvas_size if not specified
+        @return: iterator of (compositional task info, frame plan), the plan is None if prefetch is 0,
+            see TaskInfoCompo.plan_frames
+        """
+        if not prefetch:
+            for compo_info in compositional_infos:
+                yield compo_info, None
+            return
+
+        if canvas_sizes is None:
+            canvas_sizes = [self.env_spec.canvas_size]
+        obj_sizes = {self.env_spec.get_slot_table(size).obj_size for size in canvas_sizes}
+        plans = dict()
+
+        def prefetch_trial(i):
+            plans[i] = compositional_infos[i].plan_frames(stim_data)
+            refs = [ref for frame in plans[i] for ref, _ in frame]
+            for obj_size in obj_sizes:
+                stim_data.prefetch(refs, (obj_size, obj_size))
+
+        for i in range(min(prefetch, len(compositional_infos))):
+            prefetch_trial(i)
+        for i, compo_info in enumerate(compositional_infos):
+            if i + prefetch < len(compositional_infos):
+                prefetch_trial(i + prefetch)
+            yield compo_info, plans.pop(i)
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        @return: hit, miss and eviction counters of the stimulus caches, keyed by dataset split
+        """
+        return self.stim_data.cache_stats()
+
+    def close(self) -> None:
+        """
+        release the stimulus dataset, see SNStimData.close
+        """
+        self.stim_data.close()
+
+    def render_trials(
+            self,
+            compositional_infos: Iterable[ig.TaskInfoCompo],
+            mode: str = None,
+            out: np.ndarray = None,
+            prefetch: int = 0,
+            frame_format: FrameFormat = DEFAULT_FORMAT,
+    ) -> Tuple[np.ndarray, np.ndarray, List[Tuple[List[Dict], Dict]]]:
+        """
+        render a batch of trials into one array, e.g. to feed a model without building lists of frames.
+        the compositional infos are rendered as they are, distractors are not added
+        @param compositional_infos: the compositional task infos to render, see init_compositional_tasks
+        @param mode: the dataset split to sample stimuli from
+        @param out: array of shape (n_trials, n_frames, canvas_size, canvas_size, 3) to render into,
+            with n_frames at least the longest trial, and the dtype and layout of frame_format.
+            allocated if not specified
+        @param prefetch: number of upcoming trials whose stimuli are loaded in background threads
+        @param frame_format: dtype, normalization, channel order and layout of the frames, see FrameFormat
+        @return: tuple of
+            movies: the first n_trials rows of out, frames after the end of each trial are zero
+            lengths: int array of the number of frames of each trial
+            infos: list of (per task info dicts, compositional info dict) of each trial
+        """
+        self.reset_env(mode)
+        stim_data = self.get_stim_data(mode)
+        compositional_infos = list(compositional_infos)
+        canvas_size = self.env_spec.canvas_size
+
+        lengths = np.array([compo_info.n_epochs for compo_info in compositional_infos], dtype=np.int64)
+        shape = (len(compositional_infos), int(lengths.max(initial=0))) + frame_format.frame_shape(canvas_size)
+        if out is None:
+            out = np.zeros(shape, frame_format.dtype)
+        elif (out.shape[0] < shape[0] or out.shape[1] < shape[1] or out.shape[2:] != shape[2:]
+              or out.dtype != frame_format.dtype):
+            raise ValueError(f'cannot render {frame_format.dtype} trials of shape {shape} '
+                             f'into {out.dtype} array of shape {out.shape}')
+
+        movies = out[:len(compositional_infos)]
+        cue = np.zeros(movies.shape[:2], dtype=bool)
+        infos = list()
+        for i, (compo_info, plan) in enumerate(self.prefetch_trials(compositional_infos, stim_data, prefetch)):
+            # fixation cues of all trials are added at once below
+            compo_info.render(
+                canvas_size, False, self.env_spec.cue_on_action, stim_data, out=movies[i], frame_format=frame_format,
+                plan=plan,
+            )
+            movies[i, lengths[i]:] = 0
+            if self.env_spec.add_fixation_cue:
+                cue[i, :lengths[i]] = compo_info.cue_frames(self.env_spec.cue_on_action)
+            infos.append(compo_info.get_task_info_dict())
+        if self.env_spec.add_fixation_cue:
+            apply_cross(movies, cue, frame_format=frame_format)
+        return movies, lengths, infos
 
     def reset_env(self, mode: str = None) -> None:
         """
@@ -211,10 +351,7 @@ class ShapeNetEnv(Env):
         so that when env.generate_tasks(), env.generate_trials() is called,
         the tasks are generated based on self.stim_data and self.env_spec
         """
-        if mode is not None and self.stim_data.splits[mode]:
-            stim_data = self.stim_data.splits[mode]['data']
-        else:
-            stim_data = self.stim_data
+        stim_data = self.get_stim_data(mode)
 
         for base_class in self.base_classes:
             base_class._stim_data = stim_data
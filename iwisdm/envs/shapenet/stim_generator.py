@@ -240,14 +240,12 @@ class SNCategory(SNAttribute):
 
     def sample(self):
         return SNCategory(
-            value=random.choice(self.stim_data.ALLCATEGORIES)
+            value=self.stim_data.sample_category()
         )
 
     def resample(self, old_category):
-        all_cats = self.stim_data.ALLCATEGORIES.copy()
-        all_cats.remove(old_category.value)
         return SNCategory(
-            value=random.choice(all_cats)
+            value=self.stim_data.sample_category(exclude=old_category.value)
         )
 
     def __str__(self):
@@ -283,31 +281,26 @@ class SNObject(SNAttribute):
 
     def sample(self, category=None):
         if category is None:
-            category = random.choice(self.stim_data.ALLCATEGORIES)
+            category = self.stim_data.sample_category()
         else:
             category = category.value
-        obj = random.choice(self.stim_data.ALLOBJECTS[category])
+        obj = self.stim_data.sample_object(category)
         return SNObject(category=SNCategory(category), value=obj)
 
     def resample(self, old_obj):
         # sample a completely new object (category might be the same)
-        all_cats = self.stim_data.ALLCATEGORIES.copy()
-        new_category = random.choice(all_cats)
-        all_cats.remove(new_category)
-        all_objects = self.stim_data.ALLOBJECTS[new_category].copy()
-
-        if new_category == old_obj.category.value:
-            all_objects.remove(old_obj.value)
+        old_category = old_obj.category.value
+        new_category = self.stim_data.sample_category()
 
+        if new_category == old_category:
             # resample new category if no other objects in the same category
-            if not all_objects:
-                all_cats.remove(old_obj.category.value)
-                new_category = random.choice(all_cats)
-                all_objects = list(self.stim_data.ALLOBJECTS[new_category])
-                return SNObject(category=SNCategory(new_category), value=random.choice(all_objects))
-            return SNObject(category=SNCategory(new_category), value=random.choice(all_objects))
+            if self.stim_data.n_objects(old_category) < 2:
+                new_category = self.stim_data.sample_category(exclude=old_category)
+                return SNObject(category=SNCategory(new_category), value=self.stim_data.sample_object(new_category))
+            obj = self.stim_data.sample_object(new_category, exclude=old_obj.value)
+            return SNObject(category=SNCategory(new_category), value=obj)
         else:
-            return SNObject(category=SNCategory(new_category), value=random.choice(all_objects))
+            return SNObject(category=SNCategory(new_category), value=self.stim_data.sample_object(new_category))
 
     def self_json(self):
         return {'category': self.category.to_json()}
@@ -338,21 +331,20 @@ class SNViewAngle(SNAttribute):
 
     def sample(self, obj=None):
         if obj is None:
-            category = random.choice(self.stim_data.ALLCATEGORIES)
-            obj = random.choice(self.stim_data.ALLOBJECTS[category])
+            category = self.stim_data.sample_category()
+            obj = self.stim_data.sample_object(category)
         else:
             category = obj.category.value
             obj = obj.value
-        va = random.choice(self.stim_data.ALLVIEWANGLES[category][obj])
+        va = self.stim_data.sample_view_angle(category, obj)
         return SNViewAngle(
             sn_object=SNObject(category=SNCategory(category), value=obj),
             value=va)
 
     def resample(self, old_va):
         obj = old_va.object
-        all_vas = list(self.stim_data.ALLVIEWANGLES[obj.category.value][obj.value])
-        all_vas.remove(old_va.value)
-        return SNViewAngle(sn_object=obj, value=random.choice(all_vas))
+        va = self.stim_data.sample_view_angle(obj.category.value, obj.value, exclude=old_va.value)
+        return SNViewAngle(sn_object=obj, value=va)
 
     def self_json(self):
         return {'sn_object': self.object.to_json()}
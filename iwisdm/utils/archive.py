@@ -0,0 +1,153 @@
+"""
+read the stimuli dataset directly from the distributed tar archive, without extracting it
+"""
+
+import gzip
+import json
+import os
+import posixpath
+import queue
+import tarfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz')
+
+
+def is_tar_dataset(fp: str) -> bool:
+    """
+    @param fp: file path to the stimuli dataset
+    @return: True if the dataset is a tar archive
+    """
+    return fp is not None and os.path.isfile(fp) and fp.endswith(TAR_EXTENSIONS)
+
+
+class TarArchive:
+    """
+    random access reader of a tar archive.
+    the offsets of the archive members are indexed once, and saved next to the archive,
+    members are then read by seeking to their offsets using a pool of open file handles,
+    so that the archive can be read from multiple threads.
+    seeking in a compressed archive decompresses the archive up to the member,
+    decompress the archive once (e.g. gunzip shapenet_handpicked.tar.gz) for fast random access
+    Args:
+        fp: file path to the tar archive
+        n_handles: number of file handles in the pool
+    """
+
+    INDEX_VERSION = 2
+
+    def __init__(self, fp: str, n_handles: int = 8):
+        self.fp = fp
+        self.compressed = not fp.endswith('.tar')
+        self.members = self.load_index()
+        self.dirs = {posixpath.dirname(name) for name in self.members}
+        for name in list(self.dirs):
+            while name:
+                name = posixpath.dirname(name)
+                self.dirs.add(name)
+        self.n_handles = n_handles
+        self.handles = queue.LifoQueue()
+        self.n_opened = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str):
+        return name in self.members
+
+    def __getstate__(self):
+        # open file handles are not shared with other processes
+        state = self.__dict__.copy()
+        state['handles'] = queue.LifoQueue()
+        state['n_opened'] = 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def fingerprint(self) -> Tuple:
+        stat = os.stat(self.fp)
+        return self.INDEX_VERSION, os.path.abspath(self.fp), stat.st_size, stat.st_mtime_ns
+
+    def load_index(self) -> Dict[str, Tuple[int, int]]:
+        """
+        @return: dictionary of member name: (data offset, size) of the regular files in the archive
+        """
+        index_fp = f'{self.fp}.iwisdm-index.json'
+        fingerprint = self.fingerprint()
+        if os.path.isfile(index_fp):
+            try:
+                with open(index_fp) as f:
+                    index = json.load(f)
+                if index.get('fingerprint') == list(fingerprint):
+                    return {name: tuple(v) for name, v in index['members'].items()}
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+
+        members = dict()
+        with tarfile.open(self.fp, 'r:*') as tf:
+            for info in tf:
+                if info.isfile():
+                    members[posixpath.normpath(info.name)] = (info.offset_data, info.size)
+
+        tmp_fp = f'{index_fp}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_fp, 'w') as f:
+                json.dump({'fingerprint': list(fingerprint), 'members': members}, f)
+            os.replace(tmp_fp, index_fp)
+        except OSError:
+            if os.path.exists(tmp_fp):
+                os.remove(tmp_fp)
+        return members
+
+    def _open(self):
+        if self.compressed:
+            return gzip.open(self.fp, 'rb')
+        return open(self.fp, 'rb', buffering=0)
+
+    @contextmanager
+    def handle(self):
+        """
+        borrow a file handle from the pool, blocks if all handles are in use
+        """
+        try:
+            f = self.handles.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self.n_opened < self.n_handles
+                if can_open:
+                    self.n_opened += 1
+            f = self._open() if can_open else self.handles.get()
+        try:
+            yield f
+        finally:
+            self.handles.put(f)
+
+    def read(self, name: str) -> bytes:
+        """
+        @param name: the member name in the archive
+        @return: the content of the member
+        """
+        offset, size = self.members[posixpath.normpath(name)]
+        with self.handle() as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def glob(self, suffix: str) -> List[str]:
+        """
+        @return: sorted names of the members ending with suffix
+        """
+        return sorted(name for name in self.members if name.endswith(suffix))
+
+    def find_dirs(self, name: str) -> List[str]:
+        """
+        @return: the directories in the archive named name
+        """
+        return sorted(d for d in self.dirs if posixpath.basename(d) == name)
+
+    def close(self) -> None:
+        while not self.handles.empty():
+            self.handles.get_nowait().close()
+        self.n_opened = 0
@@ -0,0 +1,151 @@
+"""
+compiled on-disk form of a stimuli dataset split
+
+an atlas stores every stimulus of a split, already resized to one object size,
+as a single contiguous uint8 array of shape (n_refs, obj_size, obj_size, 3), next to a small index
+that maps each atlas row to its (ctg_mod, obj_mod, ang_mod, ref) metadata.
+atlases are opened with np.memmap so that processes share the same pages through the OS page cache
+"""
+
+import json
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+INDEX_COLUMNS = ('ctg_mod', 'obj_mod', 'ang_mod', 'ref')
+MANIFEST_FNAME = 'atlas_manifest.json'
+
+
+def read_decode_settings(dir_path: str) -> Optional[Dict]:
+    """
+    @param dir_path: the dataset split directory
+    @return: the decode settings the atlases of the split were compiled with, e.g.
+        {'reduced_decode': False, 'interpolation': cv2.INTER_LINEAR}, None if the split has no valid manifest
+    """
+    try:
+        with open(os.path.join(dir_path, MANIFEST_FNAME)) as f:
+            return json.load(f)['decode']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def atlas_paths(dir_path: str, obj_size: int) -> Tuple[str, str]:
+    """
+    @param dir_path: the dataset split directory
+    @param obj_size: the stimulus size of the atlas
+    @return: file paths of the atlas array and of the atlas index
+    """
+    return (
+        os.path.join(dir_path, f'atlas_{obj_size}.npy'),
+        os.path.join(dir_path, f'atlas_{obj_size}_index.npz'),
+    )
+
+
+class StimAtlas:
+    """
+    pre-resized stimuli of one dataset split
+    Args:
+        images: array of shape (n_refs, obj_size, obj_size, 3), usually a np.memmap
+        index: dictionary of the index columns, each an integer array of length n_refs
+    """
+
+    def __init__(self, images: NDArray, index: Dict[str, NDArray]):
+        assert images.shape[0] == len(index['ref']), 'atlas rows do not match the atlas index'
+        self.images = images
+        self.index = index
+        self.obj_size = images.shape[1]
+        # (temporary, final) file paths of an atlas being compiled, see create
+        self.pending = list()
+        self.ref_rows = {ref: i for i, ref in enumerate(index['ref'].tolist())}
+        self.key_rows = defaultdict(list)
+        for i, key in enumerate(zip(*(index[c].tolist() for c in INDEX_COLUMNS[:3]))):
+            self.key_rows[key].append(i)
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __contains__(self, ref: int):
+        return ref in self.ref_rows
+
+    def __getitem__(self, ref: int) -> NDArray:
+        """
+        @param ref: the stimulus reference in the dataset metadata
+        @return: zero-copy view of the stimulus image
+        """
+        return self.images[self.ref_rows[ref]]
+
+    def rows(self, category: int, obj: int, view_angle: int) -> List[int]:
+        """
+        @return: the atlas rows of a (ctg_mod, obj_mod, ang_mod) stimulus
+        """
+        return self.key_rows.get((category, obj, view_angle), [])
+
+    @staticmethod
+    def exists(dir_path: str, obj_size: int) -> bool:
+        return all(os.path.isfile(fp) for fp in atlas_paths(dir_path, obj_size))
+
+    @classmethod
+    def open(cls, dir_path: str, obj_size: int):
+        """
+        memory-map a compiled atlas read-only
+        @param dir_path: the dataset split directory
+        @param obj_size: the stimulus size of the atlas
+        @return: StimAtlas instance
+        """
+        atlas_fp, index_fp = atlas_paths(dir_path, obj_size)
+        images = np.load(atlas_fp, mmap_mode='r')
+        with np.load(index_fp) as f:
+            index = {c: f[c] for c in INDEX_COLUMNS}
+        return cls(images, index)
+
+    @classmethod
+    def create(cls, dir_path: str, obj_size: int, index: Dict[str, NDArray]):
+        """
+        allocate a writable atlas on disk and write its index under temporary names,
+        the caller fills atlas.images row by row and calls commit(), or discard() if compiling fails.
+        an existing atlas of the same size is removed, so that it is not served if compiling fails
+        @param dir_path: the dataset split directory
+        @param obj_size: the stimulus size of the atlas
+        @param index: dictionary of the index columns, each an integer array of length n_refs
+        @return: StimAtlas instance
+        """
+        paths = atlas_paths(dir_path, obj_size)
+        for fp in paths:
+            if os.path.isfile(fp):
+                os.remove(fp)
+        atlas_tmp_fp, index_tmp_fp = (f'{fp}.tmp' for fp in paths)
+        index = {c: np.asarray(index[c], dtype=np.int64) for c in INDEX_COLUMNS}
+        images = np.lib.format.open_memmap(
+            atlas_tmp_fp, mode='w+', dtype=np.uint8, shape=(len(index['ref']), obj_size, obj_size, 3)
+        )
+        with open(index_tmp_fp, 'wb') as f:
+            np.savez(f, **index)
+        atlas = cls(images, index)
+        atlas.pending = list(zip((atlas_tmp_fp, index_tmp_fp), paths))
+        return atlas
+
+    def flush(self) -> None:
+        if isinstance(self.images, np.memmap):
+            self.images.flush()
+
+    def commit(self) -> None:
+        """
+        flush a created atlas and move it to its final file names, once every row is written
+        """
+        self.flush()
+        for tmp_fp, fp in self.pending:
+            os.replace(tmp_fp, fp)
+        self.pending = list()
+
+    def discard(self) -> None:
+        """
+        remove the temporary files of a created atlas that was not committed
+        """
+        self.images = None
+        for tmp_fp, _ in self.pending:
+            if os.path.isfile(tmp_fp):
+                os.remove(tmp_fp)
+        self.pending = list()
@@ -0,0 +1,102 @@
+"""
+in-memory caches used when rendering trials
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+import numpy as np
+
+
+class LRUCache:
+    """
+    least recently used cache for numpy arrays, bounded by the total number of bytes held
+    Args:
+        max_bytes: upper bound on the summed nbytes of the cached arrays, 0 disables the cache
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # cached arrays are not copied to other processes
+        state = self.__dict__.copy()
+        state['_data'] = OrderedDict()
+        state['nbytes'] = 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable):
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None):
+        """
+        retrieve an array and mark it as most recently used
+        @param key: the cache key
+        @param default: returned if key is not cached
+        @return: the cached array or default
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: np.ndarray) -> np.ndarray:
+        """
+        insert an array, evicting the least recently used arrays until it fits.
+        the array is made read-only since it is shared by every later lookup,
+        also when it is not cached, so that callers get a read-only array either way
+        @param key: the cache key
+        @param value: the array to cache
+        @return: the cached array
+        """
+        value.flags.writeable = False
+        if value.nbytes > self.max_bytes:
+            return value
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._data[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        @return: dictionary of hit, miss, eviction counters and current usage
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._data),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
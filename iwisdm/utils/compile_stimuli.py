@@ -0,0 +1,128 @@
+"""
+compile the stimuli dataset into atlases, see iwisdm/utils/atlas.py
+
+usage:
+    iwisdm-compile-stimuli path/to/shapenet_handpicked --canvas_sizes 224 112
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+import cv2
+import pandas as pd
+
+from iwisdm.envs.registration import StimData, read_metadata
+from iwisdm.utils.atlas import INDEX_COLUMNS, MANIFEST_FNAME, StimAtlas, atlas_paths
+from iwisdm.utils.read_write import get_obj_size
+
+# atlases are compiled from fully decoded images, SNStimData only serves them with the same settings
+DECODE_SETTINGS = {'reduced_decode': False, 'interpolation': cv2.INTER_LINEAR}
+
+
+def file_checksum(fp: str, chunk_size: int = 2 ** 20) -> str:
+    """
+    @return: sha256 hex digest of the file content
+    """
+    sha = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def compile_split(
+        split_path: str,
+        df: pd.DataFrame,
+        obj_sizes: Iterable[int],
+        n_workers: int = None,
+) -> Dict:
+    """
+    decode every stimulus of a split once, and write one atlas per object size
+    @param split_path: the split directory with {ref}/image.png stimuli
+    @param df: the split metadata
+    @param obj_sizes: the stimulus sizes to compile
+    @param n_workers: number of decoding threads, defaults to the number of cores
+    @return: the split manifest
+    """
+    obj_sizes = sorted(set(obj_sizes))
+    df = df.drop_duplicates('ref').sort_values(list(INDEX_COLUMNS))
+    index = {c: df[c].to_numpy() for c in INDEX_COLUMNS}
+    manifest_fp = os.path.join(split_path, MANIFEST_FNAME)
+    if os.path.isfile(manifest_fp):
+        os.remove(manifest_fp)
+    atlases = [StimAtlas.create(split_path, size, index) for size in obj_sizes]
+
+    def compile_ref(row_ref):
+        row, ref = row_ref
+        fp = os.path.join(split_path, f'{ref}/image.png')
+        image = cv2.imread(fp)
+        if image is None:
+            raise ValueError(f'unable to read stimulus image {fp}')
+        for atlas in atlases:
+            atlas.images[row] = cv2.resize(
+                image, (atlas.obj_size, atlas.obj_size), interpolation=DECODE_SETTINGS['interpolation']
+            )
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+            list(executor.map(compile_ref, enumerate(index['ref'].tolist())))
+    except BaseException:
+        # partially compiled atlases are never moved to their final names
+        for atlas in atlases:
+            atlas.discard()
+        raise
+
+    manifest = {'n_refs': len(df), 'decode': DECODE_SETTINGS, 'atlases': dict()}
+    for atlas in atlases:
+        atlas.commit()
+        atlas_fp, index_fp = atlas_paths(split_path, atlas.obj_size)
+        manifest['atlases'][str(atlas.obj_size)] = {
+            os.path.basename(fp): file_checksum(fp) for fp in (atlas_fp, index_fp)
+        }
+    with open(manifest_fp, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def compile_dataset(
+        dataset_fp: str,
+        canvas_sizes: List[int],
+        n_workers: int = None,
+        grid_size: Tuple[int, int] = (2, 2),
+) -> Dict:
+    """
+    compile the atlases of every split found in the dataset folder
+    @param dataset_fp: the stimuli dataset folder, see StimData
+    @param canvas_sizes: canvas sizes to compile the stimuli for
+    @param n_workers: number of decoding threads
+    @param grid_size: the grid of the environment, see EnvSpec
+    @return: dictionary of split manifests
+    """
+    stim_data = StimData(dataset_fp)
+    obj_sizes = [get_obj_size(c, grid_size) for c in canvas_sizes]
+    manifests = dict()
+    for split, v in stim_data.splits.items():
+        if v.get('path') and v.get('meta_fp'):
+            manifests[split] = compile_split(v['path'], read_metadata(v['meta_fp']), obj_sizes, n_workers)
+    return manifests
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description='compile stimuli dataset splits into memory-mapped atlases')
+    parser.add_argument('dataset_fp', type=str, help='the stimuli dataset folder, e.g. shapenet_handpicked')
+    parser.add_argument('--canvas_sizes', type=int, nargs='+', default=[224])
+    parser.add_argument('--n_workers', type=int, default=None)
+    parser.add_argument('--grid_size', type=int, nargs=2, default=[2, 2])
+    args = parser.parse_args(args)
+
+    manifests = compile_dataset(args.dataset_fp, args.canvas_sizes, args.n_workers, tuple(args.grid_size))
+    for split, manifest in manifests.items():
+        print(f'{split}: compiled {manifest["n_refs"]} stimuli at sizes {list(manifest["atlases"].keys())}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+encodings of the frames of written trials
+"""
+
+import io
+from typing import Dict
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+
+class FrameCodec:
+    """
+    encoder and decoder of written frames
+    Args:
+        name: 'png', 'jpeg', 'webp', or 'npy' for raw arrays
+        level: PNG compression level, 0 (fastest) to 9 (smallest), the cv2 default if not specified
+        quality: JPEG and WebP quality, 0 to 100 (WebP above 100 is lossless), the cv2 default if not specified
+    """
+
+    EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'npy': '.npy'}
+
+    def __init__(self, name: str = 'png', level: int = None, quality: int = None):
+        if name not in self.EXTENSIONS:
+            raise ValueError(f'codec {name} not supported, only {list(self.EXTENSIONS.keys())}')
+        if level is not None and name != 'png':
+            raise ValueError('compression level is only supported by the png codec')
+        if quality is not None and name not in ('jpeg', 'webp'):
+            raise ValueError('quality is only supported by the jpeg and webp codecs')
+        self.name = name
+        self.level = level
+        self.quality = quality
+
+    def __repr__(self):
+        return f'FrameCodec(name={self.name}, level={self.level}, quality={self.quality})'
+
+    @property
+    def ext(self) -> str:
+        return self.EXTENSIONS[self.name]
+
+    @property
+    def params(self):
+        """
+        @return: cv2.imencode parameters
+        """
+        if self.name == 'png' and self.level is not None:
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.level]
+        if self.name == 'jpeg' and self.quality is not None:
+            return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        if self.name == 'webp' and self.quality is not None:
+            return [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        return []
+
+    def encode(self, img: NDArray) -> bytes:
+        if self.name == 'npy':
+            buf = io.BytesIO()
+            np.save(buf, img, allow_pickle=False)
+            return buf.getvalue()
+        ok, buf = cv2.imencode(self.ext, img, self.params)
+        if not ok:
+            raise ValueError(f'unable to encode frame of shape {img.shape} as {self.name}')
+        return buf.tobytes()
+
+    def decode(self, buf: bytes) -> NDArray:
+        if self.name == 'npy':
+            return np.load(io.BytesIO(buf), allow_pickle=False)
+        img = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError(f'unable to decode {self.name} frame')
+        return img
+
+    def to_dict(self) -> Dict:
+        """
+        @return: the codec description recorded in the trial metadata
+        """
+        return {'name': self.name, 'level': self.level, 'quality': self.quality}
+
+    @classmethod
+    def from_dict(cls, d: Dict = None):
+        """
+        @param d: codec description, see to_dict. the default png codec if not specified
+        """
+        return cls() if d is None else cls(d['name'], d.get('level'), d.get('quality'))
+
+    @classmethod
+    def from_ext(cls, ext: str):
+        """
+        @param ext: file extension of a frame, e.g. '.jpg'
+        @return: codec decoding frames with the extension
+        """
+        for name, codec_ext in cls.EXTENSIONS.items():
+            if ext == codec_ext:
+                return cls(name)
+        raise ValueError(f'no codec for frame extension {ext}')
+
+    @classmethod
+    def parse(cls, spec: str):
+        """
+        @param spec: the codec name, followed by the png level or the jpeg/webp quality,
+            e.g. 'png', 'png:1', 'jpeg:90', 'webp:80', 'npy'
+        """
+        name, _, value = spec.partition(':')
+        if not value:
+            return cls(name)
+        if name == 'png':
+            return cls(name, level=int(value))
+        return cls(name, quality=int(value))
+
+
+DEFAULT_CODEC = FrameCodec()
@@ -0,0 +1,109 @@
+"""
+output formats of the rendered frames
+"""
+
+from typing import Iterable, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+class FrameFormat:
+    """
+    dtype, normalization, channel order and layout of the rendered frames.
+    the stimuli are converted once when they are cached, and rendered into the output array in this format,
+    so that the frames are not converted after rendering.
+    float frames are (pixel / 255 - mean) / std
+    Args:
+        dtype: 'uint8' or 'float32'
+        mean: mean of each channel in channel_order, or one value for all channels, float32 only
+        std: standard deviation of each channel in channel_order, or one value for all channels, float32 only
+        channel_order: 'BGR' as decoded by cv2, or 'RGB'
+        layout: 'HWC' or 'CHW'
+    """
+
+    DTYPES = ('uint8', 'float32')
+    CHANNEL_ORDERS = ('BGR', 'RGB')
+    LAYOUTS = ('HWC', 'CHW')
+
+    def __init__(
+            self,
+            dtype: str = 'uint8',
+            mean: Union[float, Iterable[float]] = None,
+            std: Union[float, Iterable[float]] = None,
+            channel_order: str = 'BGR',
+            layout: str = 'HWC',
+    ):
+        if np.dtype(dtype).name not in self.DTYPES:
+            raise ValueError(f'dtype {dtype} not supported, only {self.DTYPES}')
+        if channel_order not in self.CHANNEL_ORDERS:
+            raise ValueError(f'channel order {channel_order} not supported, only {self.CHANNEL_ORDERS}')
+        if layout not in self.LAYOUTS:
+            raise ValueError(f'layout {layout} not supported, only {self.LAYOUTS}')
+        self.dtype = np.dtype(dtype)
+        if self.dtype == np.uint8 and (mean is not None or std is not None):
+            raise ValueError('normalization is only supported for float32 frames')
+        self.mean = np.broadcast_to(np.asarray(0 if mean is None else mean, np.float32), (3,)).copy()
+        self.std = np.broadcast_to(np.asarray(1 if std is None else std, np.float32), (3,)).copy()
+        self.channel_order = channel_order
+        self.layout = layout
+
+        # channel values of the canvas background and of the fixation cross
+        self.background = self.convert(np.zeros((1, 1, 3), np.uint8)).reshape(3)
+        self.white = self.convert(np.full((1, 1, 3), 255, np.uint8)).reshape(3)
+
+    def __repr__(self):
+        return (f'FrameFormat(dtype={self.dtype.name}, mean={self.mean.tolist()}, std={self.std.tolist()}, '
+                f'channel_order={self.channel_order}, layout={self.layout})')
+
+    @property
+    def key(self) -> Tuple:
+        """
+        @return: hashable description of the format, used in the cache keys
+        """
+        return self.dtype.name, tuple(self.mean.tolist()), tuple(self.std.tolist()), self.channel_order, self.layout
+
+    @property
+    def is_default(self) -> bool:
+        """
+        @return: True if the frames are the uint8 BGR HWC images decoded by cv2
+        """
+        return self.dtype == np.uint8 and self.channel_order == 'BGR' and self.layout == 'HWC'
+
+    def frame_shape(self, canvas_size: int) -> Tuple[int, int, int]:
+        if self.layout == 'CHW':
+            return 3, canvas_size, canvas_size
+        return canvas_size, canvas_size, 3
+
+    def index(self, ys, xs) -> Tuple:
+        """
+        @param ys: the rows of a region of the canvas
+        @param xs: the columns of a region of the canvas
+        @return: index of the region in a frame
+        """
+        if self.layout == 'CHW':
+            return slice(None), ys, xs
+        return ys, xs
+
+    def fill(self, canvas: NDArray) -> NDArray:
+        """
+        fill the canvas with the background, modified in place
+        """
+        canvas[...] = self.background[:, None, None] if self.layout == 'CHW' else self.background
+        return canvas
+
+    def convert(self, image: NDArray) -> NDArray:
+        """
+        @param image: uint8 BGR image array (height, width, 3)
+        @return: new image array in this format
+        """
+        if self.channel_order == 'RGB':
+            image = image[..., ::-1]
+        if self.dtype == np.float32:
+            image = (image.astype(np.float32) / 255 - self.mean) / self.std
+        if self.layout == 'CHW':
+            image = image.transpose(2, 0, 1)
+        return np.ascontiguousarray(image, dtype=self.dtype)
+
+
+DEFAULT_FORMAT = FrameFormat()
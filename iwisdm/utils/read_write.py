@@ -1,5 +1,6 @@
 import os
-from typing import Tuple, List, Union
+from functools import lru_cache
+from typing import Dict, Iterable, Tuple, List, Union
 import shutil
 from pathlib import Path
 
@@ -9,12 +10,79 @@ import numpy as np
 from numpy.typing import NDArray
 
 from iwisdm.core import StimuliSet, StimData
+from iwisdm.envs.registration import DATASET_MANIFEST, SlotTable, get_slot_table
+from iwisdm.utils.cache import LRUCache
+from iwisdm.utils.frame_codec import FrameCodec
+from iwisdm.utils.frame_format import DEFAULT_FORMAT, FrameFormat
 
 
-def read_img(fp: str, obj_size: Tuple[int, int], color_format='RGB'):
-    image = cv2.imread(fp)
+# reduction factors cv2 can apply while decoding, JPEG images are decoded at the reduced size directly
+REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+def decode_flag(obj_size: Tuple[int, int], src_size: int = None) -> int:
+    """
+    @param obj_size: the size of the stimulus on the canvas
+    @param src_size: the size of the source image, the image is decoded at full resolution if not specified
+    @return: the cv2 imread flag decoding the smallest image that is still at least obj_size
+    """
+    if src_size:
+        for factor, flag in REDUCED_DECODE_FLAGS.items():
+            if src_size // factor >= max(obj_size):
+                return flag
+    return cv2.IMREAD_COLOR
+
+
+def resize_img(image: NDArray, obj_size: Tuple[int, int], interpolation: int = cv2.INTER_LINEAR) -> NDArray:
+    if image is None:
+        raise ValueError('unable to decode stimulus image')
+    if image.shape[1::-1] == tuple(obj_size):
+        return image
+    return cv2.resize(image, obj_size, interpolation=interpolation)
+
+
+def read_img(
+        fp: str,
+        obj_size: Tuple[int, int],
+        color_format='RGB',
+        src_size: int = None,
+        interpolation: int = cv2.INTER_LINEAR,
+):
+    """
+    @param fp: file path to the image
+    @param obj_size: the size of the stimulus on the canvas
+    @param src_size: the size of the source image, if specified the image is decoded at a reduced resolution
+        before resizing, see decode_flag
+    @param interpolation: cv2 interpolation of the resize
+    @return: image array
+    """
+    image = cv2.imread(fp, decode_flag(obj_size, src_size))
     # image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if color_format == 'RGB' else image
-    object_arr = cv2.resize(image, obj_size)
+    object_arr = resize_img(image, obj_size, interpolation)
+    return object_arr
+
+
+def decode_img(
+        buf: bytes,
+        obj_size: Tuple[int, int],
+        color_format='RGB',
+        src_size: int = None,
+        interpolation: int = cv2.INTER_LINEAR,
+):
+    """
+    decode an encoded image, e.g. read from a dataset archive, and resize it like read_img
+    @param buf: the encoded image
+    @param obj_size: the size of the stimulus on the canvas
+    @param src_size: the size of the source image, see read_img
+    @param interpolation: cv2 interpolation of the resize
+    @return: image array
+    """
+    image = cv2.imdecode(np.frombuffer(buf, np.uint8), decode_flag(obj_size, src_size))
+    object_arr = resize_img(image, obj_size, interpolation)
     return object_arr
 
 
@@ -36,7 +104,61 @@ def add_cross(canvas: NDArray, cue_size: float = 0.05):
     return canvas
 
 
-def render_stim(canvas, obj, img_size, stim_data: StimData):
+@lru_cache(maxsize=None)
+def get_cross_pixels(canvas_size: int, cue_size: float = 0.05) -> Tuple[NDArray, NDArray]:
+    """
+    @param canvas_size: the size of the rendered image
+    @param cue_size: the size of the cross relative to the canvas size
+    @return: (ys, xs) indices of the pixels of the cross drawn by add_cross
+    """
+    mask = np.zeros((canvas_size, canvas_size, 1), np.uint8)
+    add_cross(mask, cue_size)
+    ys, xs = np.nonzero(mask[..., 0])
+    ys.flags.writeable, xs.flags.writeable = False, False
+    return ys, xs
+
+
+def apply_cross(
+        movie: NDArray,
+        cue: NDArray = None,
+        cue_size: float = 0.05,
+        frame_format: FrameFormat = DEFAULT_FORMAT,
+) -> NDArray:
+    """
+    add the fixation cross to many frames in one operation, the result is the same as add_cross on each frame
+    @param movie: array of frames (..., img_size, img_size, 3), e.g. a trial or a batch of trials. Modified in place.
+    @param cue: boolean array of shape movie.shape[:-3], the frames to add the cross to, all frames if not specified
+    @param cue_size: the size of the cross relative to the canvas size
+    @param frame_format: the format of the frames, e.g. (..., 3, img_size, img_size) frames for the CHW layout
+    @return: the movie
+    """
+    ys, xs = get_cross_pixels(movie.shape[-2], cue_size)
+    chw = frame_format.layout == 'CHW'
+    if cue is None:
+        if chw:
+            movie[..., ys, xs] = frame_format.white[:, None]
+        else:
+            movie[..., ys, xs, :] = frame_format.white
+        return movie
+    # the indexed pixels are (n_frames, n_pixels, 3) in both layouts
+    frames = tuple(f[:, None] for f in np.nonzero(cue))
+    if chw:
+        movie[frames + (slice(None), ys, xs)] = frame_format.white
+    else:
+        movie[frames + (ys, xs)] = frame_format.white
+    return movie
+
+
+def get_obj_size(canvas_size: int, grid_size: Tuple[int, int] = (2, 2)) -> int:
+    """
+    @param canvas_size: the size of the rendered image
+    @param grid_size: the grid of the environment, see EnvSpec
+    @return: the size of the stimuli rendered on the canvas
+    """
+    return get_slot_table(tuple(grid_size), canvas_size).obj_size
+
+
+def render_stim(canvas, obj, img_size, stim_data: StimData, slot_table: SlotTable = None):
     """Render a static object.
 
     Args:
@@ -45,47 +167,36 @@ def render_stim(canvas, obj, img_size, stim_data: StimData):
         obj: StaticObject instance
         img_size: int, image size.
         stim_data:
-        mode:
+        slot_table: placement of the stimuli in the grid cells, a 2x2 grid if not specified,
+          see EnvSpec.get_slot_table
     Returns:
         canvas: the modified frame, numpy array of type int8 (img_size, img_size, 3)
     """
-    # Fixed specifications, see Space.sample()
-    # when sampling, use a 1x1 grid, the most top-left position is (0.1, 0.1),
-    # most bottom-right position is (0.9,0.9)
-    # changing scaling requires changing space.sample)
-    radius = int(0.25 * img_size)
-
-    # Note that OpenCV color is (Blue, Green, Red)
-    # TODO: change this from manual to grid_size
-    center = [0, 0]
-    if obj.location[0] < 0.5:
-        center[0] = 56
-    else:
-        center[0] = 168
-    if obj.location[1] < 0.5:
-        center[1] = 56
-    else:
-        center[1] = 168
-    # center = (int(obj.location[0] * img_size), int(obj.location[1] * img_size))
-
-    x_offset, x_end = center[0] - radius, center[0] + radius
-    y_offset, y_end = center[1] - radius, center[1] + radius
-    obj_size = radius * 2
+    # the object is drawn centered in the grid cell containing its location, see Space.sample()
+    if slot_table is None:
+        slot_table = get_slot_table((2, 2), img_size)
+    obj_size = slot_table.obj_size
+    ys, xs = slot_table[slot_table.key_of(obj.location)]
     shape_net_obj = stim_data.get_object(obj, (obj_size, obj_size))
-    assert shape_net_obj.shape[:2] == (y_end - y_offset, x_end - x_offset)
 
     # note that openCV has x and y axis reversed
-    canvas[y_offset:y_end, x_offset:x_end] = shape_net_obj
+    canvas[ys, xs] = shape_net_obj
     return canvas
 
 
-def render_stimset(stim_set: Union[List[StimuliSet], StimuliSet], canvas_size=224, stim_data: StimData = None):
+def render_stimset(
+        stim_set: Union[List[StimuliSet], StimuliSet],
+        canvas_size=224,
+        stim_data: StimData = None,
+        slot_table: SlotTable = None,
+):
     """
     Render a movie by epoch.
 
     @param stim_set: a StimuliSet instance or a list of them
     @param canvas_size: overall size of the rendered image
     @param stim_data: the stimuli dataset
+    @param slot_table: placement of the stimuli on the canvas, see render_stim
     @return: numpy array (n_time, img_size, img_size, 3)
     """
     if not isinstance(stim_set, list):
@@ -94,8 +205,7 @@ def render_stimset(stim_set: Union[List[StimuliSet], StimuliSet], canvas_size=22
     n_objset = len(stim_set)
     n_epoch_max = max([s.n_epoch for s in stim_set])
 
-    # It's faster if use uint8 here, but later conversion to float32 seems slow
-    movie = np.zeros((n_objset * n_epoch_max, canvas_size, canvas_size, 3), np.uint8)
+    movie = get_movie(n_objset * n_epoch_max, canvas_size)
 
     i_frame = 0
     for s in stim_set:
@@ -105,11 +215,189 @@ def render_stimset(stim_set: Union[List[StimuliSet], StimuliSet], canvas_size=22
 
             subset = s.select_now(epoch_now)
             for obj in subset:
-                canvas = render_stim(canvas, obj.to_static()[0], canvas_size, stim_data)
+                canvas = render_stim(canvas, obj.to_static()[0], canvas_size, stim_data, slot_table)
             i_frame += 1
     return movie
 
 
+def get_movie(
+        n_frames: int,
+        canvas_size: int,
+        out: NDArray = None,
+        frame_format: FrameFormat = DEFAULT_FORMAT,
+) -> NDArray:
+    """
+    @return: a new movie array of n_frames in frame_format, e.g. uint8 (n_frames, canvas_size, canvas_size, 3),
+        or the first n_frames of out
+    """
+    shape = (n_frames,) + frame_format.frame_shape(canvas_size)
+    if out is None:
+        # It's faster if use uint8 here, but later conversion to float32 seems slow
+        return np.zeros(shape, frame_format.dtype)
+    if out.shape[0] < n_frames or out.shape[1:] != shape[1:] or out.dtype != frame_format.dtype:
+        raise ValueError(f'cannot render {shape} {frame_format.dtype} frames into {out.dtype} array of shape {out.shape}')
+    return out[:n_frames]
+
+
+def plan_stimset(stim_set: StimuliSet, stim_data: StimData, slot_table: SlotTable) -> List[Tuple]:
+    """
+    resolve the stimuli of every frame before rendering, sampling the stimulus references in the same order
+    as render_stimset
+    @param stim_set: a StimuliSet instance
+    @param stim_data: the stimuli dataset, with a sample_ref method, see SNStimData
+    @param slot_table: placement of the stimuli on the canvas
+    @return: frame plan, a tuple of (stimulus ref, grid key) per object for each frame
+    """
+    plan = list()
+    for epoch_now in range(stim_set.n_epoch):
+        frame = list()
+        for obj in stim_set.select_now(epoch_now):
+            obj = obj.to_static()[0]
+            ref = stim_data.sample_ref(obj.category, obj.object, obj.view_angle)
+            frame.append((ref, slot_table.key_of(obj.location)))
+        plan.append(tuple(frame))
+    return plan
+
+
+def render_frame(
+        canvas: NDArray,
+        frame: Tuple,
+        stim_data: StimData,
+        slot_table: SlotTable,
+        cue: bool,
+        frame_format: FrameFormat = DEFAULT_FORMAT,
+) -> NDArray:
+    """
+    render one frame of a frame plan
+    @param canvas: the image array, modified in place
+    @param frame: the (stimulus ref, grid key) of each object in the frame, see plan_stimset
+    @param stim_data: the stimuli dataset, with a load_object method, see SNStimData
+    @param slot_table: placement of the stimuli on the canvas
+    @param cue: if True, add the fixation cross
+    @param frame_format: the format of the canvas, the stimuli are loaded in this format
+    @return: the canvas
+    """
+    frame_format.fill(canvas)
+    obj_size = (slot_table.obj_size, slot_table.obj_size)
+    for ref, key in frame:
+        ys, xs = slot_table[key]
+        canvas[frame_format.index(ys, xs)] = stim_data.load_object(ref, obj_size, frame_format)
+    if cue:
+        apply_cross(canvas, frame_format=frame_format)
+    return canvas
+
+
+def render_plan(
+        plan: List[Tuple],
+        canvas_size: int,
+        stim_data: StimData,
+        slot_table: SlotTable,
+        cue: NDArray = None,
+        out: NDArray = None,
+        frame_cache: LRUCache = None,
+        frame_format: FrameFormat = DEFAULT_FORMAT,
+) -> NDArray:
+    """
+    Render a movie from a frame plan.
+    frames with at most one object are copied from frame_cache once rendered, with their fixation cross,
+    the other frames are rendered every time, and the fixation cross is added to them in one operation
+
+    @param plan: the frame plan, see plan_stimset
+    @param canvas_size: overall size of the rendered image
+    @param stim_data: the stimuli dataset
+    @param slot_table: placement of the stimuli on the canvas
+    @param cue: boolean array of the frames with a fixation cue
+    @param out: array with at least len(plan) frames in frame_format to render into, see get_movie
+    @param frame_cache: cache of rendered frames
+    @param frame_format: the format of the frames, see FrameFormat
+    @return: numpy array (n_time, img_size, img_size, 3), or (n_time, 3, img_size, img_size) for the CHW layout
+    """
+    movie = get_movie(len(plan), canvas_size, out, frame_format)
+    # the rendered frames to add the fixation cross to, cached frames already have it
+    render_cue = None if cue is None else np.array(cue, dtype=bool)
+    for i, frame in enumerate(plan):
+        if frame_cache is None or len(frame) > 1:
+            render_frame(movie[i], frame, stim_data, slot_table, False, frame_format)
+        else:
+            frame_cue = cue is not None and bool(cue[i])
+            movie[i] = get_cached_frame(
+                frame, canvas_size, stim_data, slot_table, frame_cue, frame_cache, frame_format
+            )
+            if render_cue is not None:
+                render_cue[i] = False
+    if render_cue is not None and render_cue.any():
+        apply_cross(movie, render_cue, frame_format=frame_format)
+    return movie
+
+
+def get_cached_frame(
+        frame: Tuple,
+        canvas_size: int,
+        stim_data: StimData,
+        slot_table: SlotTable,
+        cue: bool,
+        frame_cache: LRUCache,
+        frame_format: FrameFormat = DEFAULT_FORMAT,
+) -> NDArray:
+    """
+    @param frame: a frame of a frame plan with at most one object
+    @return: the read-only rendered frame, from frame_cache if it was rendered before
+    """
+    # frames are the same for all trials given the stimulus and its grid cell, delay frames are one blank frame
+    key = (canvas_size, slot_table.grid_size) + (frame[0] if frame else (None, None)) + (cue, frame_format.key)
+    cached = frame_cache.get(key)
+    if cached is None:
+        canvas = np.empty(frame_format.frame_shape(canvas_size), frame_format.dtype)
+        cached = frame_cache.put(key, render_frame(canvas, frame, stim_data, slot_table, cue, frame_format))
+    return cached
+
+
+def render_plan_shared(
+        plan: List[Tuple],
+        canvas_size: int,
+        stim_data: StimData,
+        slot_table: SlotTable,
+        cue: NDArray = None,
+        frame_cache: LRUCache = None,
+        frame_format: FrameFormat = DEFAULT_FORMAT,
+) -> Tuple[List[NDArray], NDArray]:
+    """
+    Render a movie from a frame plan, rendering identical frames once.
+    frames with the same stimuli and fixation cue, e.g. delay frames, are the same read-only array.
+    with frame_cache, frames with at most one object are also shared between trials
+
+    @param plan: the frame plan, see plan_stimset
+    @param canvas_size: overall size of the rendered image
+    @param stim_data: the stimuli dataset
+    @param slot_table: placement of the stimuli on the canvas
+    @param cue: boolean array of the frames with a fixation cue
+    @param frame_cache: cache of rendered frames
+    @param frame_format: the format of the frames, see FrameFormat
+    @return: list of read-only frames (img_size, img_size, 3), and the frame ids:
+        an int array with the index of each frame among the distinct frames of the movie,
+        frames with the same id are the same array
+    """
+    distinct, frame_ids = dict(), list()
+    frames = list()
+    for i, frame in enumerate(plan):
+        frame_cue = cue is not None and bool(cue[i])
+        key = (frame, frame_cue)
+        if key not in distinct:
+            if frame_cache is not None and len(frame) <= 1:
+                image = get_cached_frame(
+                    frame, canvas_size, stim_data, slot_table, frame_cue, frame_cache, frame_format
+                )
+            else:
+                image = np.empty(frame_format.frame_shape(canvas_size), frame_format.dtype)
+                render_frame(image, frame, stim_data, slot_table, frame_cue, frame_format)
+                image.flags.writeable = False
+            distinct[key] = (len(distinct), image)
+        frame_id, image = distinct[key]
+        frame_ids.append(frame_id)
+        frames.append(image)
+    return frames, np.array(frame_ids, dtype=np.int64)
+
+
 def write_task(task, save_dir_fp, task_id=None):
     """
     Write the task to a json file
@@ -128,34 +416,90 @@ def write_task(task, save_dir_fp, task_id=None):
     return
 
 
-def write_trial(imgs, compo_info_dict, trial_fp: str) -> None:
+def write_trial(imgs, compo_info_dict, trial_fp: str, verbose: bool = True, codec: FrameCodec = None) -> None:
     """
     write the trial images, and save the task information in task_info.json
 
     @param imgs: a list of numpy arrays, each array is an image
     @param compo_info_dict: a dictionary containing task information
     @param trial_fp: the directory to write the frames, usually folder name is trial_i
+    @param verbose: if True, print the trial directory
+    @param codec: the encoding of the frames, recorded as 'codec' in task_info.json, see read_trial.
+        default PNG if not specified
     @return:
     """
 
     frames_fp = os.path.join(trial_fp, 'frames')
     if os.path.exists(frames_fp):
-        print(f'\n*** removing existing trial directory at {os.path.abspath(frames_fp)}')
+        if verbose:
+            print(f'\n*** removing existing trial directory at {os.path.abspath(frames_fp)}')
         shutil.rmtree(frames_fp)
 
-    print(f'writing trial frames into {os.path.abspath(frames_fp)}')
+    if verbose:
+        print(f'writing trial frames into {os.path.abspath(frames_fp)}')
     os.makedirs(frames_fp)
 
     for i, img_arr in enumerate(imgs):
-        filename = os.path.join(frames_fp, f'epoch{i}.png')
-        cv2.imwrite(filename, img_arr)
+        if codec is None:
+            cv2.imwrite(os.path.join(frames_fp, f'epoch{i}.png'), img_arr)
+        else:
+            with open(os.path.join(frames_fp, f'epoch{i}{codec.ext}'), 'wb') as f:
+                f.write(codec.encode(img_arr))
 
+    if codec is not None:
+        compo_info_dict = dict(compo_info_dict, codec=codec.to_dict())
     filename = os.path.join(frames_fp, 'task_info.json')
     with open(filename, 'w') as f:
         json.dump(compo_info_dict, f, indent=4)
     return
 
 
+def read_trial(trial_fp: str) -> Tuple[List[NDArray], Dict]:
+    """
+    read a trial written by write_trial, the frames are decoded with the codec recorded in task_info.json
+
+    @param trial_fp: the trial directory
+    @return: the frames of the trial, and the task information
+    """
+    frames_fp = os.path.join(trial_fp, 'frames')
+    with open(os.path.join(frames_fp, 'task_info.json')) as f:
+        compo_info_dict = json.load(f)
+    codec = FrameCodec.from_dict(compo_info_dict.get('codec'))
+
+    imgs = list()
+    for i in range(compo_info_dict['epochs']):
+        with open(os.path.join(frames_fp, f'epoch{i}{codec.ext}'), 'rb') as f:
+            imgs.append(codec.decode(f.read()))
+    return imgs, compo_info_dict
+
+
+def write_trials_jsonl(
+        compo_info_dicts: Iterable[Dict],
+        fp: str,
+        keys: Iterable[str] = ('instruction', 'answers'),
+        append: bool = False,
+) -> int:
+    """
+    write the task information of many trials into a JSON lines file, one trial per line,
+    e.g. of trials generated with env.generate_trials(render=False)
+
+    @param compo_info_dicts: the compositional task info dictionaries of the trials
+    @param fp: the file path of the .jsonl file
+    @param keys: the task information written for each trial, all of it if None
+    @param append: if True, append to an existing file
+    @return: number of trials written
+    """
+    n_trials = 0
+    with open(fp, 'a' if append else 'w', buffering=2 ** 20) as f:
+        for info in compo_info_dicts:
+            if keys is not None:
+                info = {k: info[k] for k in keys}
+            f.write(json.dumps(info, separators=(',', ':')))
+            f.write('\n')
+            n_trials += 1
+    return n_trials
+
+
 def find_data_folder(data_folder: str = None):
     """
     In the project director data folder,
@@ -167,6 +511,7 @@ def find_data_folder(data_folder: str = None):
                 {train, val, test}/
                     ...
                 meta.{csv, pkl}
+    datasets with a dataset_manifest.json are recognized without searching their folder
     @param data_folder: the path to the data folder
     @return: the path to the data folder
     """
@@ -176,7 +521,10 @@ def find_data_folder(data_folder: str = None):
         for sub_dir in os.listdir(data_folder):
             dir_path = os.path.join(data_folder, sub_dir)
             if os.path.isdir(dir_path):
-                if list(Path(dir_path).rglob('*.csv')) or list(Path(dir_path).rglob('*.pkl')):
+                if os.path.isfile(os.path.join(dir_path, DATASET_MANIFEST)):
+                    return dir_path
+                # stop at the first metadata file instead of listing the whole folder
+                if next(Path(dir_path).rglob('*.csv'), None) or next(Path(dir_path).rglob('*.pkl'), None):
                     if (os.path.isdir(os.path.join(dir_path, 'train')) or os.path.isdir(
                             os.path.join(dir_path, 'validation')) or os.path.isdir(os.path.join(dir_path, 'test'))):
                         return dir_path
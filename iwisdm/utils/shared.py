@@ -0,0 +1,156 @@
+"""
+stimuli shared between generator processes through multiprocessing.shared_memory
+"""
+
+import atexit
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Iterable
+
+import numpy as np
+from numpy.typing import NDArray
+
+# the first 8 bytes of a block hold the loading state, images start at HEADER_BYTES
+HEADER_BYTES = 64
+LOADING, READY, FAILED = 0, 1, -1
+# names of the blocks created by this process, registered with its resource tracker
+_created = set()
+
+
+def shared_block_name(*keys) -> str:
+    """
+    @param keys: values identifying the stimuli of a block, e.g. the image folder, the object size and the refs
+    @return: a shared memory name that is the same in every process
+    """
+    sha = hashlib.sha1()
+    for key in keys:
+        sha.update(key.tobytes() if isinstance(key, np.ndarray) else repr(key).encode())
+    return 'iwisdm_' + sha.hexdigest()[:16]
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    attach to an existing block, without letting the resource tracker of this process
+    unlink the block when this process exits
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:  # python < 3.13
+        shm = shared_memory.SharedMemory(name)
+        if name not in _created:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedStimBlock:
+    """
+    resized stimuli of a dataset split in one shared memory block.
+    the first process creates the block and loads the stimuli into it,
+    the other processes attach to the block by name, and wait until it is loaded.
+    if loading fails, the waiting processes raise as well.
+    the creating process removes the block on close, or at exit
+    Args:
+        name: the shared memory name, see shared_block_name
+        refs: the stimulus references stored in the block, in row order
+        obj_size: the stimulus size
+        load: callable reading the image array of a ref at obj_size, used by the creating process
+        timeout: seconds to wait for another process to create and load the block
+    """
+
+    def __init__(
+            self,
+            name: str,
+            refs: Iterable[int],
+            obj_size: int,
+            load: Callable[[int], NDArray],
+            timeout: float = 600,
+    ):
+        self.refs = list(refs)
+        self.ref_rows = {ref: i for i, ref in enumerate(self.refs)}
+        self.obj_size = obj_size
+        self.closed = False
+        shape = (len(self.refs), obj_size, obj_size, 3)
+        size = HEADER_BYTES + int(np.prod(shape))
+
+        start = time.monotonic()
+        self.shm, self.owner = None, False
+        while self.shm is None:
+            try:
+                self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+                self.owner = True
+                _created.add(name)
+                atexit.register(self.close)
+                break
+            except FileExistsError:
+                pass
+            try:
+                shm = _attach(name)
+                # the block exists but the creating process has not set its size yet
+                if shm.size >= size:
+                    self.shm = shm
+                    break
+                shm.close()
+            except ValueError:  # the block is still empty
+                pass
+            except FileNotFoundError:  # the block was removed, create it again
+                continue
+            if time.monotonic() - start > timeout:
+                raise RuntimeError(f'timed out waiting for shared stimuli block {name} to be created')
+            time.sleep(0.05)
+        self.ready = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.images = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=HEADER_BYTES)
+
+        if self.owner:
+            def load_row(row_ref):
+                row, ref = row_ref
+                self.images[row] = load(ref)
+
+            try:
+                with ThreadPoolExecutor() as executor:
+                    list(executor.map(load_row, enumerate(self.refs)))
+            except Exception:
+                self.ready[0] = FAILED
+                self.close()
+                raise
+            self.ready[0] = READY
+        else:
+            while self.ready[0] != READY:
+                if self.ready[0] == FAILED:
+                    self.close()
+                    raise RuntimeError(f'loading shared stimuli block {name} failed in another process')
+                if time.monotonic() - start > timeout:
+                    raise RuntimeError(f'timed out waiting for shared stimuli block {name} to be loaded')
+                time.sleep(0.05)
+        self.images.flags.writeable = False
+
+    def __contains__(self, ref: int):
+        return ref in self.ref_rows
+
+    def __getitem__(self, ref: int) -> NDArray:
+        """
+        @return: read-only view of the stimulus image in the shared block
+        """
+        return self.images[self.ref_rows[ref]]
+
+    def close(self) -> None:
+        """
+        detach from the block, the creating process also removes the block
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.ready, self.images = None, None
+        try:
+            self.shm.close()
+        except BufferError:
+            # stimuli views are still referenced, the mapping is released when they are collected
+            pass
+        if self.owner:
+            atexit.unregister(self.close)
+            _created.discard(self.shm.name)
+            # spawned processes share the resource tracker of this process, and may have unregistered the block
+            # when attaching to it. register it again so that unlink does not fail in the tracker
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
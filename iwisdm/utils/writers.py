@@ -0,0 +1,534 @@
+"""
+writers of generated trials into few large files instead of one folder of frames per trial, see read_write.write_trial
+
+tar shards follow the WebDataset layout: the files of a trial share the trial key as basename,
+    {key}.epoch{i}.png: the frames of the trial, or the extension of the codec, see FrameCodec
+    {key}.json: the task information of the trial
+array stores keep the frames as arrays, to be read as tensors without decoding, see ArrayStoreWriter
+"""
+
+import io
+import json
+import logging
+import os
+import posixpath
+import queue
+import tarfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from iwisdm.utils.frame_codec import DEFAULT_CODEC, FrameCodec
+from iwisdm.utils.read_write import write_trial
+
+SHARD_COMPRESSIONS = (None, 'gz', 'bz2', 'xz')
+
+
+def tar_member_size(size: int) -> int:
+    """
+    @return: bytes taken in a tar archive by a member of size bytes, header and padding included
+    """
+    return tarfile.BLOCKSIZE + -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class TarShardWriter:
+    """
+    write trials into size-bounded tar shards, e.g. trials-000000.tar, trials-000001.tar, ...
+    a new shard is started when the next trial would exceed shard_size,
+    a trial is never split between shards.
+    the shard index {prefix}-index.json lists the trial keys of each shard and the frame codec,
+    and is updated when a shard is closed
+    Args:
+        dir_path: the directory to write the shards into
+        shard_size: maximum size of a shard in bytes, before compression
+        compression: None, 'gz', 'bz2' or 'xz'
+        prefix: the file name prefix of the shards
+        codec: the encoding of the frames, PNG if not specified
+    """
+
+    def __init__(
+            self,
+            dir_path: str,
+            shard_size: int = 2 ** 30,
+            compression: str = None,
+            prefix: str = 'trials',
+            codec: FrameCodec = None,
+    ):
+        if compression not in SHARD_COMPRESSIONS:
+            raise ValueError(f'compression {compression} not supported, only {SHARD_COMPRESSIONS}')
+        os.makedirs(dir_path, exist_ok=True)
+        self.dir_path = dir_path
+        self.shard_size = shard_size
+        self.compression = compression
+        self.prefix = prefix
+        self.codec = DEFAULT_CODEC if codec is None else codec
+        self.index_fp = os.path.join(dir_path, f'{prefix}-index.json')
+        self.shards = list()
+        self.n_trials = 0
+        self._tar = None
+        self._shard_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def shard_name(self, i: int) -> str:
+        ext = '.tar' if self.compression is None else f'.tar.{self.compression}'
+        return f'{self.prefix}-{i:06d}{ext}'
+
+    def _open_shard(self) -> None:
+        name = self.shard_name(len(self.shards))
+        mode = 'w' if self.compression is None else f'w:{self.compression}'
+        self._tar = tarfile.open(os.path.join(self.dir_path, name), mode)
+        self._shard_bytes = 0
+        self.shards.append({'name': name, 'n_trials': 0, 'nbytes': 0, 'keys': list()})
+
+    def _close_shard(self) -> None:
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+            self.write_index()
+
+    def write(self, imgs: List[NDArray], compo_info_dict: Dict, key: str = None) -> str:
+        """
+        write one trial
+        @param imgs: the frames of the trial
+        @param compo_info_dict: the task information of the trial
+        @param key: the trial key, trial{i} if not specified. keys must not contain dots
+        @return: the trial key
+        """
+        key = f'trial{self.n_trials}' if key is None else key
+        if '.' in key or '/' in key:
+            raise ValueError(f'trial key {key} cannot contain dots or slashes')
+        members = [(f'{key}.epoch{i}{self.codec.ext}', self.codec.encode(img)) for i, img in enumerate(imgs)]
+        members.append((f'{key}.json', json.dumps(dict(compo_info_dict, codec=self.codec.to_dict())).encode()))
+        trial_bytes = sum(tar_member_size(len(data)) for _, data in members)
+
+        if self._tar is None or (self._shard_bytes and self._shard_bytes + trial_bytes > self.shard_size):
+            self._close_shard()
+            self._open_shard()
+
+        mtime = time.time()
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            self._tar.addfile(info, io.BytesIO(data))
+        self._shard_bytes += trial_bytes
+
+        shard = self.shards[-1]
+        shard['n_trials'] += 1
+        shard['nbytes'] = self._shard_bytes
+        shard['keys'].append(key)
+        self.n_trials += 1
+        return key
+
+    def write_index(self) -> None:
+        index = {
+            'compression': self.compression,
+            'codec': self.codec.to_dict(),
+            'n_trials': self.n_trials,
+            'shards': self.shards,
+        }
+        tmp_fp = f'{self.index_fp}.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_fp, self.index_fp)
+
+    def close(self) -> None:
+        self._close_shard()
+
+
+def read_tar_shard(fp: str) -> Iterator[Tuple[str, List[NDArray], Dict]]:
+    """
+    read the trials of a shard written by TarShardWriter, the frames are decoded by their extension
+    @param fp: file path to the shard
+    @return: iterator of (trial key, frames, task information)
+    """
+    key, frames, info = None, dict(), None
+    with tarfile.open(fp, 'r:*') as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            name = posixpath.basename(member.name)
+            member_key, ext = name.split('.', 1)
+            if key is not None and member_key != key:
+                yield key, [frames[i] for i in sorted(frames)], info
+                frames, info = dict(), None
+            key = member_key
+            data = tf.extractfile(member).read()
+            if ext == 'json':
+                info = json.loads(data)
+            else:
+                epoch, frame_ext = ext.split('.', 1)
+                frames[int(epoch[len('epoch'):])] = FrameCodec.from_ext(f'.{frame_ext}').decode(data)
+    if key is not None:
+        yield key, [frames[i] for i in sorted(frames)], info
+
+
+class ArrayStoreWriter:
+    """
+    write rendered trials into chunks of concatenated frames, so that a trial is read with one contiguous read.
+    each chunk is stored in the directory as
+        chunk-{i}.bin: the frames of the trials of the chunk, written as each trial is added.
+            raw frames concatenated along the first axis, memory-mapped by ArrayStore,
+            or one zlib stream per trial with compression 'gz'
+        chunk-{i}_index.npz: offsets and lengths of the trials in frames and in bytes, the frame shape and dtype,
+            and the answers of the trials, with their own offsets and lengths.
+            merged trials can have more answers than frames, see TaskInfoCompo.get_target_value
+    and the task information of every trial is a line of metadata.jsonl, with the chunk and row of the trial.
+    a trial is never split between chunks, and only the frames of the trial being added are held in memory
+    Args:
+        dir_path: the directory to write the chunks into
+        chunk_size: maximum size of the frames of a chunk in bytes, before compression
+        compression: None, or 'gz' to compress the frames of each trial with zlib
+    """
+
+    METADATA_FNAME = 'metadata.jsonl'
+    COMPRESSIONS = (None, 'gz')
+
+    def __init__(self, dir_path: str, chunk_size: int = 2 ** 26, compression: str = None):
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f'compression {compression} not supported by array stores, only {self.COMPRESSIONS}')
+        os.makedirs(dir_path, exist_ok=True)
+        self.dir_path = dir_path
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.n_chunks = 0
+        self.n_trials = 0
+        self.frame_shape, self.dtype = None, None
+        self._file = None
+        self._lengths, self._byte_lengths, self._infos, self._keys = list(), list(), list(), list()
+        self._nbytes = 0
+        self._metadata = open(os.path.join(dir_path, self.METADATA_FNAME), 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def chunk_name(i: int) -> str:
+        return f'chunk-{i:06d}'
+
+    def write(self, imgs: List[NDArray], compo_info_dict: Dict, key: str = None) -> str:
+        """
+        add one trial to the current chunk
+        @param imgs: the frames of the trial, of the same shape and dtype in every trial
+        @param compo_info_dict: the task information of the trial
+        @param key: the trial key, trial{i} if not specified
+        @return: the trial key
+        """
+        key = f'trial{self.n_trials}' if key is None else key
+        frames = np.ascontiguousarray(np.stack(imgs))
+        if self.frame_shape is None:
+            self.frame_shape, self.dtype = frames.shape[1:], frames.dtype
+        elif frames.shape[1:] != self.frame_shape or frames.dtype != self.dtype:
+            raise ValueError(f'frames of shape {frames.shape[1:]} and dtype {frames.dtype} do not match '
+                             f'the frames of the store, of shape {self.frame_shape} and dtype {self.dtype}')
+        if self._lengths and self._nbytes + frames.nbytes > self.chunk_size:
+            self.flush()
+        if self._file is None:
+            self._file = open(os.path.join(self.dir_path, f'{self.chunk_name(self.n_chunks)}.bin'), 'wb')
+
+        data = frames.data if self.compression is None else zlib.compress(frames.data)
+        self._file.write(data)
+        self._lengths.append(len(frames))
+        self._byte_lengths.append(len(data) if self.compression else frames.nbytes)
+        self._infos.append(compo_info_dict)
+        self._keys.append(key)
+        self._nbytes += frames.nbytes
+        self.n_trials += 1
+        return key
+
+    def flush(self) -> None:
+        """
+        finish the current chunk and write its index
+        """
+        if not self._lengths:
+            return
+        self._file.close()
+        self._file = None
+
+        lengths = np.array(self._lengths, dtype=np.int64)
+        byte_lengths = np.array(self._byte_lengths, dtype=np.int64)
+        trial_answers = [[str(a) for a in info.get('answers', [])] for info in self._infos]
+        answer_lengths = np.array([len(answers) for answers in trial_answers], dtype=np.int64)
+        np.savez(
+            os.path.join(self.dir_path, f'{self.chunk_name(self.n_chunks)}_index.npz'),
+            offsets=np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64),
+            lengths=lengths,
+            byte_offsets=np.concatenate([[0], np.cumsum(byte_lengths)[:-1]]).astype(np.int64),
+            byte_lengths=byte_lengths,
+            frame_shape=np.array(self.frame_shape, dtype=np.int64),
+            dtype=np.array(self.dtype.str),
+            compression=np.array(self.compression or ''),
+            answers=np.array([a for answers in trial_answers for a in answers], dtype=str),
+            answer_offsets=np.concatenate([[0], np.cumsum(answer_lengths)[:-1]]).astype(np.int64),
+            answer_lengths=answer_lengths,
+        )
+
+        for row, (key, info) in enumerate(zip(self._keys, self._infos)):
+            record = {'key': key, 'chunk': self.n_chunks, 'row': row, 'length': int(lengths[row]), 'info': info}
+            self._metadata.write(json.dumps(record) + '\n')
+        self._metadata.flush()
+
+        self.n_chunks += 1
+        self._lengths, self._byte_lengths, self._infos, self._keys = list(), list(), list(), list()
+        self._nbytes = 0
+
+    def close(self) -> None:
+        if not self._metadata.closed:
+            self.flush()
+            self._metadata.close()
+
+
+class ArrayStore:
+    """
+    reader of the trials written by ArrayStoreWriter
+    Args:
+        dir_path: the directory of the chunks
+    """
+
+    def __init__(self, dir_path: str):
+        self.dir_path = dir_path
+        with open(os.path.join(dir_path, ArrayStoreWriter.METADATA_FNAME)) as f:
+            self.metadata = [json.loads(line) for line in f]
+        self._chunks = dict()
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def chunk(self, i: int) -> Tuple[NDArray, Dict[str, NDArray]]:
+        """
+        @return: the memory-mapped frames of chunk i, None if the chunk is compressed, and its index arrays
+        """
+        if i not in self._chunks:
+            chunk_fp = os.path.join(self.dir_path, ArrayStoreWriter.chunk_name(i))
+            with np.load(f'{chunk_fp}_index.npz') as f:
+                index = {k: f[k] for k in f.files}
+            frames = None
+            if not index['compression'].item():
+                n_frames = int(index['lengths'].sum())
+                frames = np.memmap(f'{chunk_fp}.bin', dtype=np.dtype(index['dtype'].item()), mode='r',
+                                   shape=(n_frames,) + tuple(index['frame_shape'].tolist()))
+            self._chunks[i] = (frames, index)
+        return self._chunks[i]
+
+    def __getitem__(self, i: int) -> Tuple[NDArray, Dict]:
+        """
+        @param i: the trial index, in writing order
+        @return: the frames (n_frames, ...) of the trial and its task information
+        """
+        record = self.metadata[i]
+        frames, index = self.chunk(record['chunk'])
+        row = record['row']
+        if frames is not None:
+            offset = index['offsets'][row]
+            return frames[offset:offset + record['length']], record['info']
+
+        chunk_fp = os.path.join(self.dir_path, f'{ArrayStoreWriter.chunk_name(record["chunk"])}.bin')
+        with open(chunk_fp, 'rb') as f:
+            f.seek(int(index['byte_offsets'][row]))
+            data = zlib.decompress(f.read(int(index['byte_lengths'][row])))
+        shape = (record['length'],) + tuple(index['frame_shape'].tolist())
+        return np.frombuffer(data, dtype=np.dtype(index['dtype'].item())).reshape(shape), record['info']
+
+    def answers(self, i: int) -> NDArray:
+        """
+        @return: the answers of trial i, as in its task information
+        """
+        record = self.metadata[i]
+        _, index = self.chunk(record['chunk'])
+        offset = index['answer_offsets'][record['row']]
+        length = index['answer_lengths'][record['row']]
+        n_answers = len(record['info'].get('answers', []))
+        if length != n_answers:
+            raise ValueError(f'trial {i} has {n_answers} answers, {length} are stored')
+        return index['answers'][offset:offset + length]
+
+
+class TrialWriter:
+    """
+    write trials in the folder layout of read_write.write_trial from a pool of threads.
+    frame encoding releases the GIL, so the frames of many trials are encoded and written concurrently
+    while the calling thread generates the next trials.
+    the frames of a trial must not be modified until the trial is written, e.g. after flush()
+    Args:
+        n_workers: number of writing threads, defaults to the number of cores
+        max_pending: maximum number of trials queued or being written, write() blocks until a trial is written
+        progress: called with (number of written trials, trial directory) after each trial is written,
+            or a logging.Logger logging each written trial
+        codec: the encoding of the frames, see read_write.write_trial
+    """
+
+    def __init__(
+            self,
+            n_workers: int = None,
+            max_pending: int = None,
+            progress: Union[Callable[[int, str], None], logging.Logger] = None,
+            codec: FrameCodec = None,
+    ):
+        self.n_workers = n_workers or os.cpu_count()
+        self.max_pending = max_pending or 4 * self.n_workers
+        self.progress = progress
+        self.codec = codec
+        self.n_written = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        self._slots = threading.Semaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, imgs: List[NDArray], compo_info_dict: Dict, trial_fp: str) -> None:
+        try:
+            write_trial(imgs, compo_info_dict, trial_fp, verbose=False, codec=self.codec)
+            with self._lock:
+                self.n_written += 1
+                n_written = self.n_written
+            if isinstance(self.progress, logging.Logger):
+                self.progress.info('wrote trial %d into %s', n_written, os.path.abspath(trial_fp))
+            elif self.progress is not None:
+                self.progress(n_written, trial_fp)
+        except BaseException as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+        finally:
+            self._slots.release()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, imgs: List[NDArray], compo_info_dict: Dict, trial_fp: str) -> None:
+        """
+        queue a trial to be written, see read_write.write_trial.
+        errors of previously queued trials are raised here
+        @param imgs: the frames of the trial
+        @param compo_info_dict: the task information of the trial
+        @param trial_fp: the trial directory
+        """
+        self._raise_error()
+        self._slots.acquire()
+        future = self._executor.submit(self._write, imgs, compo_info_dict, trial_fp)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+
+    def flush(self) -> None:
+        """
+        wait until the queued trials are written, and raise the first error of the writing threads
+        """
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        self._raise_error()
+
+    def close(self) -> None:
+        """
+        write the queued trials and stop the writing threads
+        """
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+class WriteBehind:
+    """
+    write trials from background threads through a bounded queue, so that trial generation and disk I/O overlap.
+    write() returns once the trial is queued, and blocks while the queue is full.
+    errors of the writing threads are raised by the next write() or by close(), the trials queued after an error
+    are dropped
+    Args:
+        writer: the writer of the trials, e.g. TarShardWriter, ArrayStoreWriter or TrialWriter,
+            with write and close methods. the writer must be thread-safe if n_threads > 1
+        max_queued: maximum number of trials waiting to be written
+        n_threads: number of writing threads
+    """
+
+    _STOP = object()
+
+    def __init__(self, writer, max_queued: int = 64, n_threads: int = 1):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._threads = [threading.Thread(target=self._drain, daemon=True) for _ in range(n_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _drain(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                if self._error is None:
+                    args, kwargs = item
+                    self.writer.write(*args, **kwargs)
+            except BaseException as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError('writing trials failed') from self._error
+
+    def write(self, *args, **kwargs) -> None:
+        """
+        queue a trial, the arguments are passed to writer.write
+        """
+        self._raise_error()
+        self._queue.put((args, kwargs))
+
+    def flush(self) -> None:
+        """
+        wait until the queued trials are written, and flush the writer if it buffers trials,
+        e.g. the pending writes of TrialWriter or the current chunk of ArrayStoreWriter
+        """
+        self._queue.join()
+        self._raise_error()
+        flush = getattr(self.writer, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def close(self) -> None:
+        """
+        write the queued trials, stop the writing threads and close the writer
+        """
+        if not any(thread.is_alive() for thread in self._threads):
+            return
+        for _ in self._threads:
+            self._queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join()
+        self.writer.close()
+        self._raise_error()